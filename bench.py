@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# pyico benchmarks.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+# Benchmarks of reading and writing synthetic icons of all supported bits
+# per pixel and sizes. Results are written as JSON so they can be compared
+# between commits:
+#   bench.py -o before.json
+#   bench.py -o after.json
+#   bench.py --compare before.json after.json
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import pyico
+from pyico import binary, bmp
+
+
+BPPS = [ 1, 4, 8, 24, 32 ]
+SIZES = [ 16, 32, 48, 128, 256 ]
+##  Minimum time of single measurement, in seconds.
+MEASURE_TIME = 0.2
+
+
+##  Reader that decodes each field separately, re-parsing format string
+##  on every call. Used as a baseline for header parsing.
+class ReaderLegacy( binary.Reader ):
+
+
+  def read( self, s_format ):
+    ABOUT = { '!': 0, '<': 0, 'B': 1, 'H': 2, 'I': 4, 'i': 4, 'f': 4 }
+    nLen = reduce( lambda x, y: x + y, [ ABOUT[ x ] for x in s_format ] )
+    sSplice = self.data_s[ self.offset_n: self.offset_n + nLen ]
+    gItems = struct.unpack( s_format, sSplice )
+    self.offset_n += nLen
+    return gItems if len( gItems ) > 1 else gItems[ 0 ]
+
+
+ENTRIES = 256
+ENTRY = struct.pack( '<BBBBHHII', 32, 32, 0, 0, 1, 32, 4264, 6 )
+HEADER = struct.pack( '<IIIHHIIiiII', 40, 32, 64, 1, 32, 0, 4096, 0, 0, 0, 0 )
+
+
+def parseEntriesLegacy():
+  oReader = ReaderLegacy( ENTRY * ENTRIES )
+  for i in range( ENTRIES ):
+    for s_format in [ '<B', '<B', '<B', '<B', '<H', '<H', '<I', '<I' ]:
+      oReader.read( s_format )
+
+
+def parseEntries():
+  oReader = binary.Reader( ENTRY * ENTRIES )
+  for i in range( ENTRIES ):
+    oReader.readRecord( pyico.ICONDIRENTRY )
+
+
+def parseHeadersLegacy():
+  oReader = ReaderLegacy( HEADER * ENTRIES )
+  for i in range( ENTRIES ):
+    for s_format in [ '<I', '<II', '<H', '<H', '<I', '<I', '<ii', '<I',
+      '<I' ]:
+      oReader.read( s_format )
+
+
+def parseHeaders():
+  oReader = binary.Reader( HEADER * ENTRIES )
+  for i in range( ENTRIES ):
+    oReader.readRecord( bmp.BITMAPINFOHEADER )
+
+
+##x Evaluates to content of uncompressed .bmp file with random pixels.
+##  Palette images has violet color that is used for transparency.
+def makeBmp( n_bpp, n_size, o_random ):
+  nLineSize = ((n_size * n_bpp + 31) / 32) * 4
+  nColors = pow( 2, n_bpp ) if n_bpp <= 8 else 0
+  lPalette = [ o_random.randrange( 1 << 24 ) for i in range( nColors ) ]
+  if nColors:
+    lPalette[ -1 ] = 0xFF00FF
+  sPalette = ''.join( struct.pack( '<I', n ) for n in lPalette )
+  if n_bpp <= 8:
+    aPixels = bytearray( n_size * n_size )
+    for i in range( len( aPixels ) ):
+      aPixels[ i ] = o_random.randrange( nColors )
+    sPixels = bmp.EnginePython.packIndexes( aPixels, n_bpp, n_size, n_size,
+      nLineSize )
+  else:
+    nPixel = n_bpp / 8
+    sPixels = ''.join( ''.join( chr( o_random.randrange( 256 ) )
+      for i in range( n_size * nPixel ) ) + '\x00' * (nLineSize - n_size *
+      nPixel) for j in range( n_size ) )
+  nOffset = bmp.HEADERS_SIZE + len( sPalette )
+  return ''.join([
+    struct.pack( '<HIHHI', 0x4D42, nOffset + len( sPixels ), 0, 0, nOffset ),
+    struct.pack( '<IIIHHIIiiII', bmp.BITMAPINFOHEADER_SIZE, n_size, n_size,
+      1, n_bpp, 0, len( sPixels ), 0, 0, nColors, nColors ),
+    sPalette,
+    sPixels ])
+
+
+##x Evaluates to dict of benchmarked callables by operation name for image of
+##  |n_bpp| bits per pixel and |n_size| pixels.
+def operations( n_bpp, n_size, s_dir ):
+  oRandom = random.Random( n_bpp * 1000 + n_size )
+  sBmp = makeBmp( n_bpp, n_size, oRandom )
+  sRaw = ''.join( chr( oRandom.randrange( 256 ) )
+    for i in range( n_size * n_size * 4 ) )
+  oIco = pyico.Ico()
+  oIco.addFromBmp( sBmp )
+  sIco = os.path.join( s_dir, "{0}_{1}.ico".format( n_bpp, n_size ) )
+  with open( sIco, 'wb' ) as oFile:
+    oFile.write( oIco.data() )
+  oImage = oIco.images_l[ 0 ]
+
+  def openIco():
+    pyico.open( sIco ).images_l[ 0 ].data_s
+
+  def openLazy():
+    pyico.open( sIco, f_lazy = True )
+
+  ##  Reassigning data discards cached encoded payload and bitmap.
+  def data():
+    oImage.data_s = sBmp
+    oIco.data()
+
+  def addFromBmp():
+    pyico.Ico().addFromBmp( sBmp )
+
+  def addFromRaw():
+    pyico.Ico().addFromRaw( sRaw, n_size, n_size, 32 )
+
+  def alpha():
+    oImage.data_s = sBmp
+    oImage.alpha()
+
+  mOperations = {
+    'open': openIco,
+    'open_lazy': openLazy,
+    'data': data,
+    'addFromBmp': addFromBmp,
+    'alpha': alpha,
+  }
+  ##  Raw data is always 32 bits per pixel.
+  if 32 == n_bpp:
+    mOperations[ 'addFromRaw' ] = addFromRaw
+  return mOperations
+
+
+##x Evaluates to best time of single |f_callable| call, in seconds.
+def measure( f_callable, n_repeat ):
+  nTime = timeit.timeit( f_callable, number = 1 )
+  nNumber = max( 1, int( MEASURE_TIME / max( nTime, 1e-6 ) ) )
+  return min( timeit.repeat( f_callable, repeat = n_repeat,
+    number = nNumber ) ) / nNumber
+
+
+##x Runs single benchmark case in a separate process, so peak memory of
+##  each case is measured independently.
+def runCase( g_case ):
+  sOperation, nBpp, nSize, nRepeat, sDir, sEngine = g_case
+  bmp.setEngine( sEngine )
+  fOperation = operations( nBpp, nSize, sDir )[ sOperation ]
+  nRssBefore = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+  nTime = measure( fOperation, nRepeat )
+  nRssAfter = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+  return {
+    'op': sOperation,
+    'bpp': nBpp,
+    'size': nSize,
+    'seconds': nTime,
+    ##  Growth of peak resident memory during the case, in kilobytes.
+    'peak_kb': nRssAfter - nRssBefore,
+  }
+
+
+def runParse( n_repeat ):
+  lResults = []
+  for sName, fBefore, fAfter in [
+    ( 'parse_ICONDIRENTRY', parseEntriesLegacy, parseEntries ),
+    ( 'parse_BITMAPINFOHEADER', parseHeadersLegacy, parseHeaders ) ]:
+    for sVariant, fCallable in [ ( 'legacy', fBefore ), ( '', fAfter ) ]:
+      lResults.append({
+        'op': sName + ('_' + sVariant if sVariant else ''),
+        'bpp': None,
+        'size': None,
+        ##  Time per parsed record.
+        'seconds': measure( fCallable, n_repeat ) / ENTRIES,
+        'peak_kb': 0,
+      })
+  return lResults
+
+
+def commit():
+  try:
+    sDir = os.path.dirname( os.path.abspath( __file__ ) )
+    with open( os.devnull, 'w' ) as oNull:
+      return subprocess.check_output( [ 'git', '-C', sDir, 'rev-parse',
+        '--short', 'HEAD' ], stderr = oNull ).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run( o_args ):
+  sDir = tempfile.mkdtemp( prefix = 'pyico_bench_' )
+  sEngine = o_args.engine or bmp.engine()
+  lCases = []
+  for nBpp in o_args.bpp:
+    for nSize in o_args.size:
+      for sOperation in sorted( operations( nBpp, 16, sDir ) ):
+        if not o_args.op or sOperation in o_args.op:
+          lCases.append( (sOperation, nBpp, nSize, o_args.repeat, sDir,
+            sEngine) )
+  lResults = runParse( o_args.repeat )
+  ##  One process per case, so memory of previous cases don't count.
+  oPool = multiprocessing.Pool( 1, maxtasksperchild = 1 )
+  try:
+    for mResult in oPool.imap( runCase, lCases ):
+      sys.stderr.write( "{op:<12} {bpp:>2} bpp {size:>3} px "
+        "{seconds:10.6f} s {peak_kb:>7} KB\n".format( ** mResult ) )
+      lResults.append( mResult )
+  finally:
+    oPool.terminate()
+    oPool.join()
+  for sName in os.listdir( sDir ):
+    os.remove( os.path.join( sDir, sName ) )
+  os.rmdir( sDir )
+  return {
+    'commit': commit(),
+    'python': platform.python_version(),
+    'engine': sEngine,
+    'results': lResults,
+  }
+
+
+##x Prints ratio of times of same cases from two results files.
+def compare( s_before, s_after ):
+  def load( s_path ):
+    with open( s_path ) as oFile:
+      mData = json.load( oFile )
+    return mData, dict( ((m[ 'op' ], m[ 'bpp' ], m[ 'size' ]), m)
+      for m in mData[ 'results' ] )
+  mBefore, mCasesBefore = load( s_before )
+  mAfter, mCasesAfter = load( s_after )
+  print "{0} -> {1}".format( mBefore[ 'commit' ], mAfter[ 'commit' ] )
+  for gKey in sorted( mCasesBefore, key = str ):
+    if gKey not in mCasesAfter:
+      continue
+    nBefore = mCasesBefore[ gKey ][ 'seconds' ]
+    nAfter = mCasesAfter[ gKey ][ 'seconds' ]
+    print "{0:<28} {1:>4} {2:>4} {3:10.6f} {4:10.6f} {5:6.2f}x".format(
+      gKey[ 0 ], gKey[ 1 ], gKey[ 2 ], nBefore, nAfter,
+      nBefore / nAfter if nAfter else float( 'inf' ) )
+
+
+def main():
+  oParser = argparse.ArgumentParser( description = "pyico benchmarks." )
+  oParser.add_argument( '-o', '--output', metavar = 'FILE',
+    help = "write JSON results into file instead of stdout" )
+  oParser.add_argument( '--bpp', type = int, nargs = '+', default = BPPS )
+  oParser.add_argument( '--size', type = int, nargs = '+', default = SIZES )
+  oParser.add_argument( '--op', nargs = '+', help = "operations to run" )
+  oParser.add_argument( '--repeat', type = int, default = 3 )
+  oParser.add_argument( '--engine', choices = bmp.engines() )
+  oParser.add_argument( '--compare', nargs = 2, metavar = 'FILE',
+    help = "compare two results files" )
+  oArgs = oParser.parse_args()
+  if oArgs.compare:
+    compare( * oArgs.compare )
+    return
+  sResults = json.dumps( run( oArgs ), indent = 2, sort_keys = True )
+  if oArgs.output:
+    with open( oArgs.output, 'w' ) as oFile:
+      oFile.write( sResults )
+  else:
+    print sResults
+
+
+if __name__ == '__main__':
+  main()
@@ -7,12 +7,29 @@
 
 # Main library code.
 
-import __builtin__, struct
-import PIL.BmpImagePlugin
-import StringIO
+##! Only light modules are imported here, so CLI workers start fast.
+##  Optional heavy dependencies are imported on first use.
+import __builtin__, hashlib, mmap, os
 
 import binary
 import bmp
+import png
+import resample
+import stats
+
+ICONDIRENTRY = binary.record( 'ICONDIRENTRY', '<BBBBHHII', [
+  'width_n',
+  'height_n',
+  'colors_n',
+  'reserved_n',
+  'planes_n',
+  'bpp_n',
+  ##  Size of image data, in bytes.
+  'size_n',
+  ##  Offset of image data from beginning of file.
+  'offset_n',
+])
+
 
 class Ico( object ):
 
@@ -21,21 +38,98 @@ class Ico( object ):
     self.images_l = []
     self._writer_o = WriterIco()
     self.file_s = ''
+    ##  Result of last |data| or |save| with |f_optimize|: list of
+    ##  |(bits per pixel, PNG flag, size before, size after)| tuples for
+    ##  each image, sizes are in bytes.
+    self.optimized_l = []
+
+
+  ##x Evaluates to copy of icon that can be modified independently. Data
+  ##  of images is immutable, so it's shared between copies.
+  def copy( self ):
+    oIco = Ico()
+    oIco.images_l = [ o.copy() for o in self.images_l ]
+    oIco.file_s = self.file_s
+    return oIco
+
+
+  ##  Writer holds data of last written icon, it's not pickled.
+  def __getstate__( self ):
+    mState = self.__dict__.copy()
+    del mState[ '_writer_o' ]
+    return mState
+
+
+  def __setstate__( self, m_state ):
+    self.__dict__.update( m_state )
+    self._writer_o = WriterIco()
+
+
+  ##x Evaluates to image that best matches |n_size| pixels and |n_bpp|
+  ##  bits per pixel, default is highest available. Image of exact size
+  ##  is preferred, then smallest larger one, then largest smaller one.
+  ##  Among images of that size, image with |n_bpp| is preferred, then
+  ##  one with highest bits per pixel. Only directory entries are used,
+  ##  so for icon opened with |f_lazy| only selected image is decoded
+  ##  when it's data is accessed.
+  def best( self, n_size, n_bpp = None ):
+    assert self.images_l, "icon has no images"
+    def key( g_item ):
+      i, oImage = g_item
+      nSize = max( oImage.width_n, oImage.height_n )
+      if nSize == n_size:
+        gSize = (0, 0)
+      elif nSize > n_size:
+        gSize = (1, nSize)
+      else:
+        gSize = (2, -nSize)
+      return gSize + (n_bpp != oImage.bpp_n, -oImage.bpp_n, i)
+    return min( enumerate( self.images_l ), key = key )[ 1 ]
 
 
   ##  Evaluates to binary data corresponding to this icon. It can be used
-  ##  to write modified icon into file.
-  def data( self ):
-    self._writer_o.clear()
-    self._writer_o.write( '<H', 0 )
-    self._writer_o.write( '<H', 1 )
-    self._writer_o.write( '<H', len( self.images_l ) )
-    for i, oImage in enumerate( self.images_l ):
-      oImage.index_n = i
-      self._writer_o.writeImage( oImage )
+  ##  to write modified icon into file. Images that are |n_pngSize| or
+  ##  more pixels wide are written as PNG compressed with |n_pngLevel|
+  ##  zlib level. If |f_optimize| is set, other images are written with
+  ##  smallest bits per pixel that keeps them exactly or as PNG, whichever
+  ##  is smaller, see |optimized_l|. If |n_threads| is more than 1, images
+  ##  are compressed and optimized in parallel.
+  def data( self, n_pngSize = None, n_pngLevel = png.LEVEL, n_threads = 1,
+    f_optimize = False ):
+    self._write( False, n_pngSize, n_pngLevel, n_threads, f_optimize )
     return self._writer_o.data()
 
 
+  ##x Writes icon into writable file object |o_file|. Images sizes are
+  ##  calculated from their headers, so icon header and directory are
+  ##  written first and each image is encoded and written after that,
+  ##  one by one: only one encoded image is held in memory at a time.
+  ##  Size of PNG image is not known until it's compressed, so images
+  ##  written as PNG, see |data|, are compressed before writing.
+  def save( self, o_file, n_pngSize = None, n_pngLevel = png.LEVEL,
+    n_threads = 1, f_optimize = False ):
+    self._write( True, n_pngSize, n_pngLevel, n_threads, f_optimize )
+    try:
+      self._writer_o.save( o_file )
+    finally:
+      self._writer_o.clear()
+
+
+  ##x Same as |data|, but icon is encoded in background, see |aio|.
+  ##  Evaluates to |AsyncResult| for icon data.
+  def adata( self, o_executor = None, f_callback = None ):
+    ##  Imported here since it's slow to import and rarely used.
+    import aio
+    return aio.adata( self, o_executor, f_callback )
+
+
+  ##x Same as |save|, but icon is encoded and written in background, see
+  ##  |aio|. |o_file| can also be a name of file to write.
+  def asave( self, o_file, o_executor = None, f_callback = None ):
+    import aio
+    return aio.asave( self, o_file, o_executor, f_callback )
+
+
   ##x Adds new image from uncompressed .bmp file content.
   def addFromBmp( self,
     ##i Image data as loaded from |.bmp| file.
@@ -44,63 +138,280 @@ class Ico( object ):
     ##  to specified. Used if image is programmatically generated (for
     ##  expample, via PIL) and generator can't produce required bits per
     ##  pixel for .bmp format (for example, PIL can't create 4 bits per
-    ##  pixel BMP).
-    n_bpp = None ):
+    ##  pixel BMP). Colors are reduced if image don't fit, see
+    ##  |bmp.Bmp.quantize|.
+    n_bpp = None,
+    ##i If set, dithering is used when colors are reduced.
+    f_dither = False ):
 
     oBmp = bmp.Bmp()
-    oBmp.fromBmp( s_data, n_bpp )
+    oBmp.fromBmp( s_data, n_bpp, f_dither )
     oImage = Image()
     oImage.initFromBmp( oBmp )
     self.images_l.append( oImage )
 
 
   ##x Adds new image from raw 32-bit data in 'RGBA' fromat, first 4
-  ##  bytes are top-left corner.
-  def addFromRaw( self, s_data, n_width, n_height, n_bpp ):
-    assert 32 == n_bpp
+  ##  bytes are top-left corner. Image is converted to |n_bpp| bits per
+  ##  pixel, see |bmp.Bmp.convert|.
+  def addFromRaw( self, s_data, n_width, n_height, n_bpp = 32,
+    f_dither = False ):
 
     oBmp = bmp.Bmp()
-    oBmp.fromRaw( s_data, n_width, n_height, n_bpp )
+    oBmp.fromRaw( s_data, n_width, n_height, n_bpp, f_dither )
     oImage = Image()
     oImage.initFromBmp( oBmp )
     self.images_l.append( oImage )
 
 
+  ##x Adds images of all |l_sizes| sizes, default is |resample.SIZES|,
+  ##  from single large raw 32-bit image in 'RGBA' fromat. Sizes are
+  ##  resampled in parallel by |n_processes| processes, default is
+  ##  number of CPUs.
+  def addSizesFromRaw( self, s_data, n_width, n_height, l_sizes = None,
+    n_processes = None ):
+
+    lSizes = l_sizes or resample.SIZES
+    lData = resample.resampleSizes( s_data, n_width, n_height, lSizes,
+      n_processes )
+    for nSize, sData in zip( lSizes, lData ):
+      self.addFromRaw( sData, nSize, nSize, 32 )
+
+
+  def _write( self, f_stream = False, n_pngSize = None,
+    n_pngLevel = png.LEVEL, n_threads = 1, f_optimize = False ):
+    lPayloads = self._encodeImages( n_pngSize, n_pngLevel, n_threads,
+      f_optimize )
+    self._writer_o.clear()
+    self._writer_o.write( '<H', 0 )
+    self._writer_o.write( '<H', 1 )
+    self._writer_o.write( '<H', len( self.images_l ) )
+    for i, oImage in enumerate( self.images_l ):
+      oImage.index_n = i
+      self._writer_o.writeImage( oImage, f_stream, lPayloads[ i ] )
+
+
+  ##  Evaluates to list of |WriterIco.writeImage| payloads for images that
+  ##  must be written as PNG or optimized, |None| for other images.
+  def _encodeImages( self, n_pngSize, n_pngLevel, n_threads, f_optimize ):
+    def encode( o_image ):
+      if o_image.png_f:
+        return None
+      if n_pngSize is not None and o_image.width_n >= n_pngSize:
+        return self._writer_o.encodePng( o_image, n_pngLevel )
+      if f_optimize:
+        return self._writer_o.optimize( o_image, n_pngLevel )
+      return None
+    if n_pngSize is None and not f_optimize:
+      return [ None ] * len( self.images_l )
+    if n_threads <= 1 or len( self.images_l ) <= 1:
+      lPayloads = map( encode, self.images_l )
+    else:
+      ##  Imported here since it's slow to import. zlib releases GIL
+      ##  while compressing, so threads are enough.
+      import multiprocessing.pool
+      oPool = multiprocessing.pool.ThreadPool( n_threads )
+      try:
+        lPayloads = oPool.map( encode, self.images_l, chunksize = 1 )
+      finally:
+        oPool.terminate()
+        oPool.join()
+    if f_optimize:
+      self.optimized_l = []
+      for oImage, gPayload in zip( self.images_l, lPayloads ):
+        nBefore = self._writer_o.encodedSize( oImage )
+        if gPayload is None:
+          self.optimized_l.append( (oImage.bpp_n, oImage.png_f, nBefore,
+            nBefore) )
+        else:
+          sData, _, nBpp = gPayload
+          self.optimized_l.append( (nBpp, png.SIGNATURE == sData[ : 8 ],
+            nBefore, len( sData )) )
+    return lPayloads
+
+
 class Image( object ):
 
 
+  __slots__ = [
+    'width_n',
+    'height_n',
+    'colors_n',
+    'planes_n',
+    'bpp_n',
+    '_data_s',
+    'png_f',
+    'index_n',
+    '_encoded_o',
+    '_bitmap_o',
+    '_raw_s',
+    '_alpha_s',
+    '_shared_o',
+  ]
+
+
   def __init__( self ):
     self.width_n = 0
     self.height_n = 0
     self.colors_n = 0
     self.planes_n = 0
     self.bpp_n = 0
-    self.data_s = 0
+    ##  |None| if image was read lazily and is not decoded yet.
+    self._data_s = ''
     ##  if set to |True|, data is in compressed |png| format alongside
     ##  with header.
     self.png_f = False
     ##  0-based index of this image inside .ico. Used by writer to
     ##  distinguish images in order to correctly write offset/sizes.
     self.index_n = None
+    ##  Image data encoded for .ico file, as read from file or written
+    ##  by |WriterIco|. Reset if |data_s| is changed, so unchanged images
+    ##  are written back as is, without decoding and encoding. Can be
+    ##  a string or a zero-copy view of file data.
+    self._encoded_o = None
+    ##  Decoded bitmap, it's 'RGBA' and alpha data. Evaluated on first
+    ##  access and reset if |data_s| is changed.
+    self._bitmap_o = None
+    self._raw_s = None
+    self._alpha_s = None
+    ##  Image that was read from same file offset, so it's decoded data
+    ##  can be reused instead of decoding same payload again.
+    self._shared_o = None
+
+
+  ##x Evaluates to copy of image that can be modified independently.
+  def copy( self ):
+    oImage = Image()
+    for sName in Image.__slots__:
+      setattr( oImage, sName, getattr( self, sName ) )
+    return oImage
+
+
+  ##  Decoded data is not pickled, it's evaluated again on first access.
+  ##  Encoded data can be a view of file data, so it's pickled as a
+  ##  string.
+  def __getstate__( self ):
+    mState = dict( (s, getattr( self, s )) for s in Image.__slots__
+      if s not in [ '_shared_o', '_bitmap_o', '_raw_s', '_alpha_s' ] )
+    if mState[ '_encoded_o' ] is not None:
+      mState[ '_encoded_o' ] = str( mState[ '_encoded_o' ] )
+    return mState
+
+
+  def __setstate__( self, m_state ):
+    Image.__init__( self )
+    for sName, oValue in m_state.items():
+      setattr( self, sName, oValue )
+
+
+  ##  .bmp file content for |BMP| images or .png file content for |PNG|
+  ##  images.
+  @property
+  def data_s( self ):
+    if self._data_s is None:
+      self._decode()
+    return self._data_s
+
+
+  @data_s.setter
+  def data_s( self, s_data ):
+    self._encoded_o = None
+    self._bitmap_o = None
+    self._raw_s = None
+    self._alpha_s = None
+    self._data_s = s_data
 
 
   def initFromBmp( self, o_bmp ):
+    self.initHeaderFromBmp( o_bmp )
+    self.data_s = o_bmp.toBmp()
+
+
+  ##  Same as |initFromBmp|, but only image parameters are updated, so
+  ##  it can be used with bitmap that has only headers read.
+  def initHeaderFromBmp( self, o_bmp ):
     self.width_n = o_bmp.width()
     self.height_n = o_bmp.height()
     self.colors_n = o_bmp.colors()
     self.planes_n = 1
     self.bpp_n = o_bmp.bpp()
-    self.data_s = o_bmp.toBmp()
 
 
+  ##  Evaluates to decoded bitmap, PNG images are decoded into 32-bit
+  ##  bitmap. Bitmap is cached, so it must not be modified: assign
+  ##  |data_s| or use |initFromBmp| to change image.
+  def bitmap( self ):
+    if self._bitmap_o is None:
+      oBmp = bmp.Bmp()
+      if self.png_f:
+        nWidth, nHeight, sRaw = png.decode( self.data_s )
+        oBmp.fromRaw( sRaw, nWidth, nHeight, 32 )
+        self._raw_s = sRaw
+      else:
+        oBmp.fromBmp( self.data_s )
+      self._bitmap_o = oBmp
+    return self._bitmap_o
+
+
+  ##  Evaluates to 8-bit alpha array, first item is top-left corner.
   def alpha( self ):
-    oBmp = bmp.Bmp()
-    oBmp.fromBmp( self.data_s )
-    return oBmp.alpha()
+    if self._alpha_s is None:
+      self._alpha_s = self.bitmap().alpha()
+    return self._alpha_s
+
+
+  ##  Evaluates to raw 32-bit data in 'RGBA' fromat, first 4 bytes are
+  ##  top-left corner.
+  def raw( self ):
+    if self._raw_s is None:
+      self._raw_s = self.bitmap().toRaw()
+    return self._raw_s
+
+
+  ##  Evaluates to |(r, g, b, a)| of pixel, (0, 0) is top-left corner.
+  def pixel( self, n_x, n_y ):
+    nOffset = (n_y * self.bitmap().width() + n_x) * 4
+    return tuple( bytearray( self.raw()[ nOffset : nOffset + 4 ] ) )
+
+
+  ##  Decodes |self._encoded_o| into |self._data_s|.
+  def _decode( self ):
+    oShared = self._shared_o
+    self._shared_o = None
+    if oShared is not None and oShared._encoded_o is self._encoded_o:
+      ##  Payload is decoded once for all images that share it.
+      oShared.data_s
+      if oShared._encoded_o is self._encoded_o:
+        nIndex = self.index_n
+        for sName in Image.__slots__:
+          setattr( self, sName, getattr( oShared, sName ) )
+        self.index_n = nIndex
+        return
+    with stats.phase( 'decode' ):
+      self._decodePayload()
+    stats.count( 'bytes.read', len( self._encoded_o ) )
+
+
+  def _decodePayload( self ):
+    oPayload = self._encoded_o
+    if self.png_f:
+      self._data_s = str( oPayload )
+    else:
+      ##  Read .ico version of BMP file (with doubled height,
+      ##  'AND' transparency image etc) and convert to a BMP file data so
+      ##  it can be writen back to valid .bmp file.
+      oBmp = bmp.Bmp()
+      oBmp.fromIco( oPayload )
+      ##! Otherwrite image header data from |BMP| file structure, since
+      ##  it can be corrpupted: for example, |bpp| value can be 0.
+      self.initFromBmp( oBmp )
+      ##  Decoding don't change image.
+      self._encoded_o = oPayload
 
 
   def __str__( self ):
-    return "IMAGE: {width_n}x{height_n}x{bpp_n}".format( ** self.__dict__ )
+    return "IMAGE: {0}x{1}x{2}".format( self.width_n, self.height_n,
+      self.bpp_n )
 
   def __repr__( self ):
     return self.__str__()
@@ -109,42 +420,48 @@ class Image( object ):
 class ReaderIco( binary.Reader ):
 
 
-  def readImage( self ):
+  def __init__( self, o_data ):
+    super( ReaderIco, self ).__init__( o_data )
+    ##  Images by |(offset, size)| of their payload, so directory entries
+    ##  that point to same payload share it.
+    self._images_m = {}
+
 
+  ##x Reads image directory entry. If |f_lazy| is set, only directory
+  ##  entry is read and image payload is decoded on first access.
+  def readImage( self, f_lazy = False ):
+
+    with stats.phase( 'read.header' ):
+      oEntry = self.readRecord( ICONDIRENTRY )
     oImage = Image()
-    oImage.width_n = self.read( '<B' )
-    if 0 == oImage.width_n:
-      oImage.width_n = 256
-    oImage.height_n = self.read( '<B' )
-    if 0 == oImage.height_n:
-      oImage.height_n = 256
-    oImage.colors_n = self.read( '<B' )
-    assert 0 == self.read( '<B' )
-    oImage.planes_n = self.read( '<H' )
+    ##  0 means 256.
+    oImage.width_n = oEntry.width_n or 256
+    oImage.height_n = oEntry.height_n or 256
+    oImage.colors_n = oEntry.colors_n
+    assert 0 == oEntry.reserved_n
+    oImage.planes_n = oEntry.planes_n
     assert oImage.planes_n in [ 0, 1 ]
-    oImage.bpp_n = self.read( '<H' )
-    nData = self.read( '<I' )
-    nOffset = self.read( '<I' )
-
-    self.push( nOffset )
-    oImage.data_s = self.readArray( nData )
-    self.pop()
+    oImage.bpp_n = oEntry.bpp_n
+    nData = oEntry.size_n
+    nOffset = oEntry.offset_n
 
     ##  .ico don't have any means to distinguish BMP and PNG data, so
     ##  PNG is detected by 8-byte signature.
-    PNG_MAGIC = '\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'
-    if nData > 8 and oImage.data_s.startswith( PNG_MAGIC ):
+    sMagic = self.data_s[ nOffset : nOffset + len( png.SIGNATURE ) ]
+    if nData > 8 and png.SIGNATURE == sMagic:
       oImage.png_f = True
     else:
       oImage.png_f = False
-      ##  Read .ico version of BMP file (with doubled height,
-      ##  'AND' transparency image etc) and convert to a BMP file data so
-      ##  it can be writen back to valid .bmp file.
-      oBmp = bmp.Bmp()
-      oBmp.fromIco( oImage.data_s )
-      ##! Otherwrite image header data from |BMP| file structure, since
-      ##  it can be corrpupted: for example, |bpp| value can be 0.
-      oImage.initFromBmp( oBmp )
+
+    oShared = self._images_m.setdefault( (nOffset, nData), oImage )
+    if oShared is oImage:
+      oImage._encoded_o = binary.view( self.data_s, nOffset, nData )
+    else:
+      oImage._encoded_o = oShared._encoded_o
+      oImage._shared_o = oShared
+    oImage._data_s = None
+    if not f_lazy:
+      oImage._decode()
 
     return oImage
 
@@ -152,53 +469,269 @@ class ReaderIco( binary.Reader ):
 class WriterIco( binary.Writer ):
 
 
-  def writeImage( self, o_image ):
+  def __init__( self ):
+    super( WriterIco, self ).__init__()
+    ##  Id of image whose payload is written by payload key, so identical
+    ##  payloads are written once, see |_share|.
+    self._payloads_m = {}
+
+
+  def clear( self ):
+    super( WriterIco, self ).clear()
+    self._payloads_m = {}
+
+
+  ##x Writes image directory entry and image data. Images that are not
+  ##  changed since they were read or written are written as is. If
+  ##  |f_stream| is set, only bitmap headers are decoded now and image
+  ##  data is encoded when written via |save|. If |g_payload| is
+  ##  specified, it's |(data, colors, bpp)| that is written instead of
+  ##  image data, see |encodePng| and |optimize|.
+  def writeImage( self, o_image, f_stream = False, g_payload = None ):
+
+    if g_payload is not None:
+      o_image.initHeaderFromBmp( o_image.bitmap() )
+      sData, nColors, nBpp = g_payload
+      self._writeEntry( o_image, nColors, nBpp )
+      self._writePayload( o_image.index_n, [ _key( 'ico', sData ) ], sData )
+      return
+
+    if not f_stream or o_image._encoded_o is not None or o_image.png_f:
+      oData = self.encodeImage( o_image )
+      self._writeEntry( o_image )
+      lKeys = [ _key( 'ico', oData ) ]
+      ##  Bitmap is known if image is decoded, so same new images that are
+      ##  streamed refer to this payload, see below.
+      if o_image._data_s is not None and not o_image.png_f:
+        lKeys.append( _key( 'bmp', o_image._data_s ) )
+      self._writePayload( o_image.index_n, lKeys, oData )
+      return
 
     oBmp = bmp.Bmp()
-    oBmp.fromBmp( o_image.data_s )
+    oBmp.fromBmpHeader( o_image.data_s )
     ##  User can assign new bitmap, so reload image parameters from it.
-    o_image.initFromBmp( oBmp )
+    o_image.initHeaderFromBmp( oBmp )
+    self._writeEntry( o_image )
+
+    ##! Encoded data is not cached, so only one encoded image is held in
+    ##  memory at a time.
+    def encode():
+      oBmp = bmp.Bmp()
+      oBmp.fromBmp( o_image.data_s )
+      return oBmp.toIco()
+    ##  Same bitmaps are encoded into same payloads.
+    if not self._share( o_image.index_n, [ _key( 'bmp', o_image.data_s ) ] ):
+      self.writeDeferredEnd( oBmp.icoSize(), encode, n_id = o_image.index_n )
+
+
+  ##x Evaluates to image data as it's written into .ico file. Images that
+  ##  are not changed since they were read or written are written as is.
+  ##  Image parameters are updated from image data.
+  def encodeImage( self, o_image ):
+    if o_image._encoded_o is not None:
+      return o_image._encoded_o
+    ##  PNG images are written as is.
+    if o_image.png_f:
+      oHeader = png.header( o_image.data_s )
+      o_image.width_n = oHeader.width_n
+      o_image.height_n = oHeader.height_n
+      o_image.colors_n = 0
+      o_image.planes_n = 1
+      o_image.bpp_n = png.bpp( oHeader )
+      o_image._encoded_o = o_image.data_s
+    else:
+      oBmp = o_image.bitmap()
+      ##  User can assign new bitmap, so reload image parameters from it.
+      o_image.initHeaderFromBmp( oBmp )
+      o_image._encoded_o = oBmp.toIco()
+    return o_image._encoded_o
+
+
+  ##x Evaluates to payload for |writeImage| that is image converted to
+  ##  32-bit PNG with |n_level| zlib compression level.
+  def encodePng( self, o_image, n_level = png.LEVEL ):
+    oBmp = o_image.bitmap()
+    return (png.encode( oBmp.toRaw(), oBmp.width(), oBmp.height(),
+      n_level ), 0, 32)
+
+
+  ##x Evaluates to payload for |writeImage| that is image converted to
+  ##  smallest bits per pixel that keeps all it's visible pixels, or to
+  ##  PNG with |n_pngLevel| zlib compression level if smaller. Evaluates
+  ##  to |None| if image is smallest as is.
+  def optimize( self, o_image, n_pngLevel = png.LEVEL ):
+    oBmp = o_image.bitmap()
+    sRaw = oBmp.toRaw()
+    nBpp = bmp.losslessBpp( sRaw )
+    lCandidates = [ self.encodePng( o_image, n_pngLevel ) ]
+    if nBpp < oBmp.bpp():
+      oSmall = bmp.Bmp()
+      oSmall.fromRaw( sRaw, oBmp.width(), oBmp.height(), nBpp )
+      lCandidates.append( (oSmall.toIco(), oSmall.colors(), nBpp) )
+    gBest = min( lCandidates, key = lambda g: len( g[ 0 ] ) )
+    if len( gBest[ 0 ] ) >= self.encodedSize( o_image ):
+      return None
+    return gBest
+
+
+  ##x Evaluates to size of image data written by |writeImage| without
+  ##  payload, in bytes.
+  def encodedSize( self, o_image ):
+    if o_image._encoded_o is not None:
+      return len( o_image._encoded_o )
+    if o_image.png_f:
+      return len( o_image.data_s )
+    return o_image.bitmap().icoSize()
+
+
+  ##  Writes image payload |o_data| with |l_keys|, or makes image |n_id|
+  ##  refer to same payload that is already written.
+  def _writePayload( self, n_id, l_keys, o_data ):
+    if not self._share( n_id, l_keys ):
+      self.writeArrayEnd( o_data, n_id = n_id )
+
+
+  ##  Evaluates to |True| if payload with any of |l_keys| is already
+  ##  written, in which case image |n_id| refers to it. Otherwise payload
+  ##  of image |n_id| is registered with all keys.
+  def _share( self, n_id, l_keys ):
+    for gKey in l_keys:
+      nId = self._payloads_m.get( gKey )
+      if nId is not None:
+        self.writeAlias( n_id, nId )
+        return True
+    for gKey in l_keys:
+      self._payloads_m[ gKey ] = n_id
+    return False
+
+
+  ##  Entry is written for image parameters, |n_colors| and |n_bpp| can
+  ##  be specified if image is written converted.
+  def _writeEntry( self, o_image, n_colors = None, n_bpp = None ):
+    self.write( '<BBBBHH', * self.entry( o_image, n_colors, n_bpp ) )
+    self.writeSize( '<I', o_image.index_n )
+    self.writeOffset( '<I', o_image.index_n )
+
+
+  ##x Evaluates to |ICONDIRENTRY| fields of image without size and offset.
+  def entry( self, o_image, n_colors = None, n_bpp = None ):
 
     nWidth = o_image.width_n
     assert nWidth <= 256
     if 256 == nWidth:
       nWidth = 0
-    self.write( '<B', nWidth )
 
-    nHeight = o_image.width_n
+    nHeight = o_image.height_n
     assert nHeight <= 256
     if 256 == nHeight:
       nHeight = 0
-    self.write( '<B', o_image.height_n )
     if 256 == o_image.colors_n:
       o_image.colors_n = 0
-    self.write( '<B', o_image.colors_n )
-    self.write( '<B', 0 )
-    self.write( '<H', o_image.planes_n )
-    self.write( '<H', o_image.bpp_n )
+    if n_colors is None:
+      n_colors = o_image.colors_n
+    if n_bpp is None:
+      n_bpp = o_image.bpp_n
+    return (nWidth, nHeight, n_colors % 256, 0, o_image.planes_n, n_bpp)
 
-    self.writeSize( '<I', o_image.index_n )
-    self.writeOffset( '<I', o_image.index_n )
 
-    self.writeArrayEnd( oBmp.toIco(), n_id = o_image.index_n )
+##  Evaluates to key of payload or bitmap |o_data| for |WriterIco._share|.
+def _key( s_kind, o_data ):
+  return (s_kind, hashlib.sha1( o_data ).digest())
 
 
-def open( fp, mode = 'r' ):
+##x Reads .ico file. If |f_lazy| is set, only icon header and image
+##  directory are parsed, each image is decoded on first access to it's
+##  data. If |f_mmap| is set, file is memory-mapped instead of being read
+##  into memory.
+def open( fp, mode = 'r', f_lazy = False, f_mmap = False ):
   assert 'r' == mode
   with __builtin__.open( fp, mode + 'b' ) as oFile:
-    oReader = ReaderIco( oFile.read() )
-  oIco = Ico()
+    if f_mmap:
+      ##  Mapping remains valid after file is closed. Images keep views
+      ##  of it as encoded data even after they are decoded, so it's
+      ##  unmapped only after all images are collected or their |data_s|
+      ##  is assigned.
+      oData = mmap.mmap( oFile.fileno(), 0, access = mmap.ACCESS_READ )
+    else:
+      oData = oFile.read()
+  oIco = load( oData, f_lazy )
   oIco.file_s = fp
+  return oIco
+
+
+##x Same as |open|, but file is read and decoded in background, see |aio|.
+##  Evaluates to |AsyncResult| for |Ico|.
+def aopen( fp, f_lazy = False, f_mmap = False, o_executor = None,
+  f_callback = None ):
+  import aio
+  return aio.aopen( fp, f_lazy, f_mmap, o_executor, f_callback )
 
-  ##  Read header
-  assert 0 == oReader.read( '<H' )
-  assert 1 == oReader.read( '<H' )
-  nImages = oReader.read( '<H' )
-  assert nImages > 0
+
+##x Reads .ico file content from string, |mmap| or any other object
+##  supporting buffer protocol.
+def load( o_data, f_lazy = False ):
+  oReader = ReaderIco( o_data )
+  oIco = Ico()
+
+  with stats.phase( 'read.header' ):
+    ##  Read header
+    assert 0 == oReader.read( '<H' )
+    assert 1 == oReader.read( '<H' )
+    nImages = oReader.read( '<H' )
+    assert nImages > 0
 
   for i in range( nImages ):
-    oImage = oReader.readImage()
+    oImage = oReader.readImage( f_lazy )
     oIco.images_l.append( oImage )
+  stats.count( 'bytes.read', oReader.offset_n )
 
   return oIco
 
+
+##x Replaces image |n_index| of .ico file |fp| with |o_image| without
+##  reading, decoding and writing other images. Image data is written
+##  over old data if it fits and is not shared with other images, else
+##  it's appended to the end of file, then directory entry is patched. If
+##  |f_compact| is set, file is compacted afterwards, see |compact|.
+##! File is modified in place, so it's corrupted if writing fails.
+def update( fp, n_index, o_image, f_compact = False ):
+  oWriter = WriterIco()
+  oData = oWriter.encodeImage( o_image )
+  with __builtin__.open( fp, 'r+b' ) as oFile:
+    with stats.phase( 'read.header' ):
+      oReader = binary.Reader( oFile.read( 6 ) )
+      assert 0 == oReader.read( '<H' )
+      assert 1 == oReader.read( '<H' )
+      nImages = oReader.read( '<H' )
+      assert 0 <= n_index < nImages
+      nEntry = ICONDIRENTRY.STRUCT.size
+      oReader = binary.Reader( oFile.read( nImages * nEntry ) )
+      lEntries = [ oReader.readRecord( ICONDIRENTRY )
+        for i in range( nImages ) ]
+    oEntry = lEntries[ n_index ]
+    nEnd = oEntry.offset_n + oEntry.size_n
+    ##  Data can be shared with other entries, see |WriterIco|.
+    fShared = any( o.offset_n < nEnd and o.offset_n + o.size_n >
+      oEntry.offset_n for i, o in enumerate( lEntries ) if i != n_index )
+    if not fShared and len( oData ) <= oEntry.size_n:
+      nOffset = oEntry.offset_n
+    else:
+      oFile.seek( 0, os.SEEK_END )
+      nOffset = oFile.tell()
+    oFile.seek( nOffset )
+    oFile.write( oData )
+    oFile.seek( 6 + n_index * nEntry )
+    oFile.write( ICONDIRENTRY.STRUCT.pack( * oWriter.entry( o_image ) +
+      (len( oData ), nOffset) ) )
+    stats.count( 'bytes.written', len( oData ) + nEntry )
+  if f_compact:
+    compact( fp )
+
+
+##x Rewrites .ico file |fp| without unused space left by |update|. Images
+##  are not decoded, their data is written as is.
+def compact( fp ):
+  oIco = open( fp, f_lazy = True )
+  sData = oIco.data()
+  with __builtin__.open( fp, 'wb' ) as oFile:
+    oFile.write( sData )
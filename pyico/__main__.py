@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico command-line entry point.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+import sys
+
+from pyico import cli
+
+sys.exit( cli.main() )
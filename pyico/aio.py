@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico background reading and writing.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+# File I/O, decoding and encoding are performed by executor threads, so
+# they don't block caller's event loop. Each operation evaluates to
+# |multiprocessing.pool.AsyncResult| and calls optional callback with
+# result in executor thread.
+
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+import pyico
+
+
+class Executor( object ):
+
+
+  ##x Operations are performed by pool of |n_workers| threads, default is
+  ##  number of CPUs, or by existing |o_pool| that implements
+  ##  |multiprocessing.pool.ThreadPool| interface. If |n_limit| is
+  ##  specified, no more than |n_limit| operations are performed at once,
+  ##  so a burst of operations don't load all icons into memory. Pending
+  ##  operations only hold their arguments.
+  def __init__( self, n_workers = None, n_limit = None, o_pool = None ):
+    if o_pool is None:
+      o_pool = multiprocessing.pool.ThreadPool( n_workers or
+        multiprocessing.cpu_count() )
+      self._own_f = True
+    else:
+      self._own_f = False
+    self._pool_o = o_pool
+    self._limit_o = None
+    if n_limit is not None:
+      self._limit_o = threading.BoundedSemaphore( n_limit )
+
+
+  ##x Calls |f_callable| with |args| in executor thread. Evaluates to
+  ##  |AsyncResult|, |f_callback| is called with result on success.
+  def submit( self, f_callable, args = (), f_callback = None ):
+    return self._pool_o.apply_async( self._call, (f_callable, args),
+      callback = f_callback )
+
+
+  ##x Waits for all submitted operations. Pool passed to constructor is
+  ##  not closed.
+  def close( self ):
+    if self._own_f:
+      self._pool_o.close()
+      self._pool_o.join()
+
+
+  def _call( self, f_callable, args ):
+    if self._limit_o is None:
+      return f_callable( * args )
+    with self._limit_o:
+      return f_callable( * args )
+
+
+_executor_o = None
+_executorLock_o = threading.Lock()
+
+
+##x Sets executor that is used by default.
+def setExecutor( o_executor ):
+  global _executor_o
+  _executor_o = o_executor
+
+
+##x Evaluates to default executor, it's created on first use.
+def executor():
+  global _executor_o
+  with _executorLock_o:
+    if _executor_o is None:
+      _executor_o = Executor()
+    return _executor_o
+
+
+##x Same as |pyico.open|, but file is read and decoded by |o_executor|,
+##  default is |executor()|. Evaluates to |AsyncResult| for |Ico|.
+def aopen( fp, f_lazy = False, f_mmap = False, o_executor = None,
+  f_callback = None ):
+  oExecutor = o_executor or executor()
+  return oExecutor.submit( pyico.open, (fp, 'r', f_lazy, f_mmap),
+    f_callback )
+
+
+##x Same as |Ico.data|, but icon is encoded by |o_executor|, default is
+##  |executor()|. Evaluates to |AsyncResult| for icon data.
+def adata( o_ico, o_executor = None, f_callback = None ):
+  oExecutor = o_executor or executor()
+  return oExecutor.submit( o_ico.data, (), f_callback )
+
+
+##x Same as |Ico.save|, but icon is encoded and written by |o_executor|,
+##  default is |executor()|. |o_file| is a writable file object or name
+##  of file to write. Evaluates to |AsyncResult| for |None|.
+def asave( o_ico, o_file, o_executor = None, f_callback = None ):
+  oExecutor = o_executor or executor()
+  return oExecutor.submit( _save, (o_ico, o_file), f_callback )
+
+
+def _save( o_ico, o_file ):
+  if isinstance( o_file, basestring ):
+    with open( o_file, 'wb' ) as oFile:
+      o_ico.save( oFile )
+  else:
+    o_ico.save( o_file )
@@ -6,32 +6,83 @@
 # See LICENSE for details.
 
 import struct
+import collections
+
+import stats
+
+
+##  Compiled |struct.Struct| objects by format string, so formats are
+##  parsed only once.
+_STRUCTS = {}
+
+
+##x Evaluates to compiled |struct.Struct| for |s_format|.
+def compiled( s_format ):
+  oStruct = _STRUCTS.get( s_format )
+  if oStruct is None:
+    oStruct = _STRUCTS[ s_format ] = struct.Struct( s_format )
+  return oStruct
+
+
+##x Declares binary record type: named tuple |s_name| with |l_fields|
+##  that are decoded by |Reader.readRecord| in a single call using
+##  |s_format|.
+def record( s_name, s_format, l_fields ):
+  oRecord = collections.namedtuple( s_name, l_fields )
+  oRecord.STRUCT = compiled( s_format )
+  return oRecord
+
+
+##x Zero-copy view of |n_len| bytes of |o_data| starting at |n_offset|.
+##  |o_data| can be a string, |mmap| or any other object supporting
+##  buffer protocol.
+##! |memoryview| can't be created for |mmap| objects, so old-style
+##  |buffer| is used.
+def view( o_data, n_offset, n_len ):
+  return buffer( o_data, n_offset, n_len )
 
 
 class Reader( object ):
 
 
-  def __init__( self, s_data ):
-    self.data_s = s_data
+  ##x |o_data| can be a string, |mmap| or any other object supporting
+  ##  buffer protocol. Data is decoded in-place, without intermediate
+  ##  copies.
+  def __init__( self, o_data ):
+    self.data_s = o_data
     self.offset_n = 0
     self.offsets_l = []
 
 
   def read( self, s_format ):
-    ABOUT = { '!': 0, '<': 0, 'B': 1, 'H': 2, 'I': 4, 'i': 4, 'f': 4 }
-    nLen = reduce( lambda x, y: x + y, [ ABOUT[ x ] for x in s_format ] )
-    sSplice = self.data_s[ self.offset_n: self.offset_n + nLen ]
-    gItems = struct.unpack( s_format, sSplice )
-    self.offset_n += nLen
+    oStruct = compiled( s_format )
+    gItems = oStruct.unpack_from( self.data_s, self.offset_n )
+    self.offset_n += oStruct.size
     return gItems if len( gItems ) > 1 else gItems[ 0 ]
 
 
+  ##x Reads whole record of type |o_record| created via |record|.
+  def readRecord( self, o_record ):
+    oStruct = o_record.STRUCT
+    oRecord = o_record._make( oStruct.unpack_from( self.data_s,
+      self.offset_n ) )
+    self.offset_n += oStruct.size
+    return oRecord
+
+
   def readArray( self, n_len ):
     sSplice = self.data_s[ self.offset_n: self.offset_n + n_len ]
     self.offset_n += n_len
     return sSplice
 
 
+  ##  Same as |readArray|, but evaluates to zero-copy view of data.
+  def readView( self, n_len ):
+    oView = view( self.data_s, self.offset_n, n_len )
+    self.offset_n += n_len
+    return oView
+
+
   def push( self, n_newOffset ):
     self.offsets_l.append( self.offset_n )
     self.offset_n = n_newOffset
@@ -41,52 +92,50 @@ class Reader( object ):
     self.offset_n = self.offsets_l.pop()
 
 
+##  Kinds of |Writer| chunks.
+CHUNK_DATA = 0
+CHUNK_OFFSET = 1
+CHUNK_SIZE = 2
+CHUNK_DEFERRED = 3
+
+
 class Writer( object ):
 
 
   def __init__( self ):
+    ##  Chunks are |(kind, data, argument, id)| tuples. For |CHUNK_DATA|
+    ##  data is binary string, for |CHUNK_OFFSET| and |CHUNK_SIZE| it's
+    ##  format of value to be written and argument is id of chunk whose
+    ##  offset or size is written. For |CHUNK_DEFERRED| data is callable
+    ##  that evaluates to binary string and argument is it's size.
     self.chunks_l = []
+    ##  Chunks that has 'end' flag and must be written after all other
+    ##  chunks.
+    self.chunksEnd_l = []
+    ##  Chunk id by id of chunk that has same offset and size, see
+    ##  |writeAlias|.
+    self.aliases_m = {}
 
 
   def data( self ):
-    sData = ""
-
-    ##  Data that has 'end' flag must be written after data without it.
-    self.chunks_l = [ o for o in self.chunks_l if not o[ 'end_f' ] ] + \
-      [ o for o in self.chunks_l if o[ 'end_f' ] ]
+    ##  Chunks can be zero-copy views of data.
+    sData = ''.join( map( str, self._iterData() ) )
+    stats.count( 'bytes.written', len( sData ) )
+    return sData
 
-    ##  Calculate sizes and offsets of all data, so items marked as
-    ##  'size' and 'offset' can be assigned correct values.
-    nOffset = 0
-    for mChunk in self.chunks_l:
-      if mChunk[ 'type_s' ] in [ 'offset', 'size' ]:
-        mChunk[ 'size_n' ] = len( struct.pack( mChunk[ 'format_s' ], 0 ) )
-      else:
-        mChunk[ 'size_n' ] = len( mChunk[ 'data_s' ] )
-      mChunk[ 'offset_n' ] = nOffset
-      nOffset += mChunk[ 'size_n' ]
-
-
-    for mChunk in self.chunks_l:
-      if mChunk[ 'type_s' ] in [ 'offset', 'size' ]:
-        ##  Find chunk whose offset or size must be written.
-        nId = mChunk[ 'target_n' ]
-        lChunks = [ o for o in self.chunks_l if o[ 'id_n' ] == nId ]
-        ##  Id not found or not unique?
-        assert 1 == len( lChunks )
-        if 'offset' == mChunk[ 'type_s' ]:
-          nVal = lChunks[ 0 ][ 'offset_n' ]
-        if 'size' == mChunk[ 'type_s' ]:
-          nVal = lChunks[ 0 ][ 'size_n' ]
-        sData += struct.pack( mChunk[ 'format_s' ], nVal )
-      else:
-        sData += mChunk[ 'data_s' ]
 
-    return sData
+  ##x Writes data into writable file object |o_file| chunk by chunk, so
+  ##  deferred chunks are evaluated one at a time.
+  def save( self, o_file ):
+    for sData in self._iterData():
+      o_file.write( sData )
+      stats.count( 'bytes.written', len( sData ) )
 
 
   def clear( self ):
     self.chunks_l = []
+    self.chunksEnd_l = []
+    self.aliases_m = {}
 
 
   def write( self, s_format, * args ):
@@ -113,42 +162,79 @@ class Writer( object ):
       args = [ s_data ] )
 
 
+  ##x Writes |n_size| bytes that will be evaluated by calling |f_data|
+  ##  only when data is written.
+  def writeDeferredEnd( self, n_size, f_data, n_id = None ):
+    self.chunksEnd_l.append( (CHUNK_DEFERRED, f_data, n_size, n_id) )
+
+
+  ##x Makes chunk id |n_id| refer to already written chunk |n_targetId|,
+  ##  so offsets and sizes written for both ids point to same data.
+  def writeAlias( self, n_id, n_targetId ):
+    self.aliases_m[ n_id ] = n_targetId
+
+
   def writeOffset( self, s_format, n_offsetId ):
-    self.chunks_l.append({
-      'type_s': 'offset',
-      'format_s': s_format,
-      'target_n': n_offsetId,
-      'end_f': False,
-      'id_n': None,
-    })
+    self.chunks_l.append( (CHUNK_OFFSET, s_format, n_offsetId, None) )
 
 
   def writeSize( self, s_format, n_sizeId ):
-    self.chunks_l.append({
-      'type_s': 'size',
-      'format_s': s_format,
-      'target_n': n_sizeId,
-      'end_f': False,
-      'id_n': None,
-    })
+    self.chunks_l.append( (CHUNK_SIZE, s_format, n_sizeId, None) )
 
 
   def _write( self, s_format, f_end, n_id, args ):
     ##  Write some integers in specified binary format?
     if s_format:
-      self.chunks_l.append({
-        'type_s': 'data',
-        'data_s': struct.pack( s_format, * args ),
-        'end_f': f_end,
-        'id_n': n_id,
-      })
+      sData = compiled( s_format ).pack( * args )
     ##  Write array?
     else:
       assert 1 == len( args ) and args[ 0 ]
-      self.chunks_l.append({
-        'type_s': 'array',
-        'data_s': args[ 0 ],
-        'end_f': f_end,
-        'id_n': n_id,
-      })
+      sData = args[ 0 ]
+    lChunks = self.chunksEnd_l if f_end else self.chunks_l
+    lChunks.append( (CHUNK_DATA, sData, None, n_id) )
+
+
+  ##  Calculates offsets and sizes of all chunks with id in a single pass
+  ##  so chunks of type 'size' and 'offset' can be assigned correct
+  ##  values. Evaluates to dict of |(offset, size)| by chunk id.
+  def _layout( self ):
+    mLayout = {}
+    nOffset = 0
+    with stats.phase( 'write.layout' ):
+      for nKind, sData, nArg, nId in self.chunks_l + self.chunksEnd_l:
+        if CHUNK_DATA == nKind:
+          nSize = len( sData )
+        elif CHUNK_DEFERRED == nKind:
+          nSize = nArg
+        else:
+          nSize = compiled( sData ).size
+        if nId is not None:
+          ##  Id not unique?
+          assert nId not in mLayout
+          mLayout[ nId ] = (nOffset, nSize)
+        nOffset += nSize
+      for nId, nTargetId in self.aliases_m.items():
+        ##  Id not unique?
+        assert nId not in mLayout
+        mLayout[ nId ] = mLayout[ nTargetId ]
+    return mLayout
+
+
+  ##  Evaluates chunks data one by one.
+  def _iterData( self ):
+    mLayout = self._layout()
+    for nKind, sData, nArg, _ in self.chunks_l + self.chunksEnd_l:
+      if CHUNK_DATA == nKind:
+        yield sData
+      elif CHUNK_DEFERRED == nKind:
+        sData = sData()
+        ##  Size must be known before data is evaluated.
+        assert nArg == len( sData )
+        yield sData
+      else:
+        ##  Id not found?
+        assert nArg in mLayout
+        nOffset, nSize = mLayout[ nArg ]
+        nVal = nOffset if CHUNK_OFFSET == nKind else nSize
+        yield compiled( sData ).pack( nVal )
 
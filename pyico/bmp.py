@@ -5,19 +5,55 @@
 # Copyright 2013 Grigory Petrov
 # See LICENSE for details.
 
+import re
 import struct
 
 import binary
+import stats
+
+##  Optional |numpy| module, imported on first use by |_numpy| since it's
+##  slow to import. |False| if it's not available.
+numpy = None
 
 
 BITMAPFILEHEADER_SIZE = 14
 BITMAPINFOHEADER_SIZE = 40
 HEADERS_SIZE = BITMAPFILEHEADER_SIZE + BITMAPINFOHEADER_SIZE
+BITMAPINFOHEADER = binary.record( 'BITMAPINFOHEADER', '<IIIHHIIiiII', [
+  'size_n',
+  'width_n',
+  'height_n',
+  'planes_n',
+  'bpp_n',
+  'compression_n',
+  'imageSize_n',
+  'resCx_n',
+  'resCy_n',
+  'colors_n',
+  'important_n',
+])
+##  Bytes per pixel in decoded image with more than 8 bits per pixel.
+COLOR_SIZE = 4
+TRANSPARENT_COLOR = '\xFF\x00\xFF'
 
 
 class Bmp( object ):
 
 
+  __slots__ = [
+    '_width_n',
+    '_height_n',
+    '_bpp_n',
+    '_resCx_n',
+    '_resCy_n',
+    '_colors_n',
+    '_lineSize_n',
+    '_palette_l',
+    '_pixels_a',
+    '_alpha_a',
+  ]
+
+
   def __init__( self ):
     self._width_n = 0
     self._height_n = 0
@@ -30,11 +66,15 @@ class Bmp( object ):
     self._lineSize_n = 0
     ##  List of (r, g, b) tuples.
     self._palette_l = []
-    ##  Two-dimenshional array. If |self._bpp_n| <= 8, contains indexes
-    ##  of colors in |self._palette_l|, otherwise contains (r,g,b,a) tuples.
-    self._pixels_l = []
-    ##  Two-dimenshional array, 1 is transparent.
-    self._alpha_l = []
+    ##  Lines of pixels, bottom line first, as in .bmp file. If
+    ##  |self._bpp_n| <= 8, contains one byte per pixel that is index of
+    ##  color in |self._palette_l|, otherwise contains |COLOR_SIZE| bytes
+    ##  per pixel: color bytes as in .bmp file followed by alpha (0 for
+    ##  24-bit images).
+    self._pixels_a = bytearray()
+    ##  Same lines layout as |self._pixels_a|, one byte per pixel, 1 is
+    ##  transparent.
+    self._alpha_a = bytearray()
 
 
   def width( self ):
@@ -69,27 +109,33 @@ class Bmp( object ):
     ##  each pixel.
     ##! 32-bit .BMP has alpha channel written into every 4-th byte. Windows
     ##  will not be able to display it, but programs like GIMP will.
-    if self._bpp_n < 32:
+    with stats.phase( 'decode.mask' ):
+      if self._bpp_n < 32:
 
-      self._readAlpha( oReader )
-      if self._bpp_n <= 8:
-        nTransparent = self._defineTransparentColor()
-        assert nTransparent is not None
-
-      ##  Actual color replacement.
-      for i in range( self._height_n ):
-        for j in range( self._width_n ):
-          if not 0 == self._alpha_l[ i ][ j ]:
-            if self._bpp_n <= 8:
-              self._pixels_l[ i ][ j ] = nTransparent
-            else:
-              nAlpha = self._pixels_l[ i ][ j ][ 3 ]
-              self._pixels_l[ i ][ j ] = (0xFF, 0, 0xFF, nAlpha)
+        self._readAlpha( oReader )
+        if self._bpp_n <= 8:
+          nTransparent = self._defineTransparentColor()
+          assert nTransparent is not None
+
+        ##  Actual color replacement, by runs of transparent pixels.
+        aPixels = self._pixels_a
+        for oMatch in re.finditer( '\x01+', str( self._alpha_a ) ):
+          nBegin, nEnd = oMatch.span()
+          nLen = nEnd - nBegin
+          if self._bpp_n <= 8:
+            aPixels[ nBegin : nEnd ] = chr( nTransparent ) * nLen
+          else:
+            for i, sColor in enumerate( TRANSPARENT_COLOR ):
+              aPixels[ nBegin * COLOR_SIZE + i : nEnd * COLOR_SIZE :
+                COLOR_SIZE ] = sColor * nLen
+      else:
+        self._alpha_a = self._alphaMask()
 
 
   ##x Decodes BMP information from uncompressed .BMP file and stores it in
-  ##  internal representation.
-  def fromBmp( self, s_data, n_bpp = None ):
+  ##  internal representation. If |n_bpp| is less than image bits per
+  ##  pixel, image is converted, see |convert|.
+  def fromBmp( self, s_data, n_bpp = None, f_dither = False ):
 
     oReader = binary.Reader( s_data )
     ##  Skip BITMAPFILEHEADER
@@ -100,60 +146,124 @@ class Bmp( object ):
     self._readPixels( oReader )
     ##  Override bits per pixels value if required (see caller for details).
     if n_bpp is not None and n_bpp < self._bpp_n:
-      assert n_bpp <= 8
-      self._bpp_n = n_bpp
-      self._colors_n = pow( 2, n_bpp )
-      self._lineSize_n = self._lineSize( self._width_n, self._bpp_n )
-      self._palette_l = self._palette_l[ : pow( 2, n_bpp ) ]
-      for i in range( self._height_n ):
-        for j in range( self._width_n ):
-          assert self._pixels_l[ i ][ j ] < pow( 2, n_bpp )
-    ##  Create alpha mask based on image colors.
-    nSide = self._width_n
-    self._alpha_l = [ [ 0 for x in range( nSide ) ] for y in range( nSide ) ]
-    nTransparent = self._defineTransparentColor()
-    for i in range( nSide ):
-      for j in range( nSide ):
-        if self._bpp_n <= 8:
-          if self._pixels_l[ i ][ j ] == nTransparent:
-            self._alpha_l[ i ][ j ] = 1
-          else:
-            self._alpha_l[ i ][ j ] = 0
-        if 24 == self._bpp_n:
-          if (0xFF, 0, 0xFF) == self._pixels_l[ i ][ j ][ : 3 ]:
-            self._alpha_l[ i ][ j ] = 1
-          else:
-            self._alpha_l[ i ][ j ] = 0
-        if 32 == self._bpp_n:
-          if self._pixels_l[ i ][ j ][ 3 ] < 128:
-            self._alpha_l[ i ][ j ] = 1
-          else:
-            self._alpha_l[ i ][ j ] = 0
+      self.convert( n_bpp, f_dither )
+    with stats.phase( 'decode.mask' ):
+      self._maskFromColors()
+
+
+  ##x Converts image to |n_bpp| bits per pixel, that is less than current.
+  ##  Images are converted to palette via |quantize|, 32-bit images are
+  ##  converted to 24-bit by replacing transparent pixels with violet.
+  ##  Alpha mask must be recreated after conversion.
+  def convert( self, n_bpp, f_dither = False ):
+    assert n_bpp < self._bpp_n
+    if n_bpp <= 8:
+      self.quantize( n_bpp, f_dither )
+      return
+    assert 24 == n_bpp
+    aTransparent = self._alphaMask()
+    lRuns = [ o.span() for o in re.finditer( '\x01+', str( aTransparent ) ) ]
+    for i, sColor in enumerate( TRANSPARENT_COLOR ):
+      aColor = self._pixels_a[ i :: COLOR_SIZE ]
+      for nBegin, nEnd in lRuns:
+        aColor[ nBegin : nEnd ] = sColor * (nEnd - nBegin)
+      self._pixels_a[ i :: COLOR_SIZE ] = aColor
+    self._pixels_a[ COLOR_SIZE - 1 :: COLOR_SIZE ] = \
+      bytearray( len( aTransparent ) )
+    self._bpp_n = n_bpp
+    self._lineSize_n = self._lineSize( self._width_n, self._bpp_n )
+
+
+  ##x Converts image to palette of |n_bpp| <= 8 bits per pixel. Palette
+  ##  images whose pixels already fit keep their palette if it has violet
+  ##  or unused color for transparent pixels. Otherwise, if image has few
+  ##  enough colors, palette is made of them exactly, else colors are
+  ##  reduced by median cut and, if |f_dither| is set, Floyd-Steinberg
+  ##  dithering. Last palette color is reserved for transparent pixels.
+  def quantize( self, n_bpp, f_dither = False ):
+    assert n_bpp <= 8
+    nColors = pow( 2, n_bpp )
+    gViolet = tuple( bytearray( TRANSPARENT_COLOR ) )
+    lPalette = None
+    if self._bpp_n <= 8 and max( self._pixels_a or [ 0 ] ) < nColors:
+      lPalette = self._palette_l[ : nColors ]
+      lPalette += [ (0, 0, 0) ] * (nColors - len( lPalette ))
+      ##  See |_defineTransparentColor|.
+      if gViolet not in lPalette and len( set( self._pixels_a ) ) >= nColors:
+        lPalette = None
+    if lPalette is not None:
+      self._palette_l = lPalette
+    else:
+      ##  Colors are |(b, g, r)| tuples, as in palette.
+      aPixels = self._pixels_a
+      if self._bpp_n <= 8:
+        lColors = [ self._palette_l[ i ] for i in aPixels ]
+        lTransparent = [ False ] * len( lColors )
+      else:
+        lColors = zip( aPixels[ 0 :: COLOR_SIZE ], aPixels[ 1 :: COLOR_SIZE ],
+          aPixels[ 2 :: COLOR_SIZE ] )
+        lTransparent = self._alphaMask() if 32 == self._bpp_n else \
+          [ False ] * len( lColors )
+      lTransparent = [ f or gViolet == g for f, g in zip( lTransparent,
+        lColors ) ]
+      mCounts = {}
+      for gColor, fTransparent in zip( lColors, lTransparent ):
+        if not fTransparent:
+          mCounts[ gColor ] = mCounts.get( gColor, 0 ) + 1
+      nTransparent = nColors - 1
+      if len( mCounts ) <= nTransparent:
+        lPalette = sorted( mCounts )
+        mIndexes = dict( (g, i) for i, g in enumerate( lPalette ) )
+      else:
+        lPalette, mIndexes = _medianCut( mCounts, nTransparent )
+      if f_dither and len( mCounts ) > nTransparent:
+        lIndexes = _dither( lColors, lTransparent, lPalette, nTransparent,
+          self._width_n )
+      else:
+        lIndexes = [ nTransparent if f else mIndexes[ g ]
+          for g, f in zip( lColors, lTransparent ) ]
+      lPalette += [ (0, 0, 0) ] * (nTransparent - len( lPalette ))
+      self._palette_l = lPalette + [ gViolet ]
+      self._pixels_a = bytearray( lIndexes )
+    self._bpp_n = n_bpp
+    self._colors_n = nColors
+    self._lineSize_n = self._lineSize( self._width_n, self._bpp_n )
+
+
+  ##x Decodes only headers of uncompressed .BMP file, so image
+  ##  parameters and |icoSize| are available without decoding pixels.
+  def fromBmpHeader( self, s_data ):
+
+    oReader = binary.Reader( s_data )
+    ##  Skip BITMAPFILEHEADER
+    oReader.readArray( BITMAPFILEHEADER_SIZE )
+    self._readBitmapHeader( oReader )
 
 
   ##  Constructs image from raw 32-bit data in 'RGBA' fromat, first 4
-  ##  bytes are top-left corner.
-  def fromRaw( self, s_data, n_width, n_height, n_bpp ):
-    assert 32 == n_bpp
+  ##  bytes are top-left corner. If |n_bpp| is less than 32, image is
+  ##  converted, see |convert|.
+  def fromRaw( self, s_data, n_width, n_height, n_bpp = 32,
+    f_dither = False ):
 
     self._width_n = n_width
     self._height_n = n_height
-    self._bpp_n = n_bpp
+    self._bpp_n = 32
     self._resCx_n = 0
     self._resCy_n = 0
     self._colors_n = 0
     self._lineSize_n = self._lineSize( self._width_n, self._bpp_n )
     self._palette_l = []
-    self._alpha_l = []
-    nSide = self._width_n
-    self._pixels_l = [ [ 0 for x in range( nSide ) ] for y in range( nSide ) ]
-    for i in range( self._height_n ):
-      for j in range( self._width_n ):
-        self._pixels_l[ self._height_n - i - 1 ][ j ] = (
-          ord( s_data[ (i * self._width_n + j) * 4 + 0 ] ),
-          ord( s_data[ (i * self._width_n + j) * 4 + 1 ] ),
-          ord( s_data[ (i * self._width_n + j) * 4 + 2 ] ),
-          ord( s_data[ (i * self._width_n + j) * 4 + 3 ] ) )
+    nStride = self._width_n * COLOR_SIZE
+    ##  Raw data lines are top to bottom.
+    aRaw = bytearray( _flip( s_data[ : nStride * self._height_n ], nStride ) )
+    self._pixels_a = bytearray( aRaw )
+    ##  Color bytes in .bmp file are in 'BGR' order.
+    self._pixels_a[ 0 :: COLOR_SIZE ] = aRaw[ 2 :: COLOR_SIZE ]
+    self._pixels_a[ 2 :: COLOR_SIZE ] = aRaw[ 0 :: COLOR_SIZE ]
+    if n_bpp < self._bpp_n:
+      self.convert( n_bpp, f_dither )
+    self._maskFromColors()
 
 
   ##  Evaluates to binary representation of loaded image that can be stored
@@ -161,67 +271,78 @@ class Bmp( object ):
   ##  information section in ICO file.
   def toIco( self ):
 
-    sData = ''
-    sData += self._createBitmapHeader( f_ico = True )
-    sData += self._createPalette()
-    sData += self._createPixels()
-    sData += self._createAlpha()
+    return ''.join([
+      self._createBitmapHeader( f_ico = True ),
+      self._createPalette(),
+      self._createPixels(),
+      self._createAlpha() ])
 
-    return sData
+
+  ##  Evaluates to size of |toIco| result, in bytes.
+  def icoSize( self ):
+    nMaskLineSize = self._lineSize( self._width_n, n_bpp = 1 )
+    return BITMAPINFOHEADER_SIZE + self._colors_n * 4 + \
+      (self._lineSize_n + nMaskLineSize) * self._height_n
 
 
   ##  Evaluates to binary representation of loaded image that can be
   ##  saved as .BMP file.
   def toBmp( self ):
 
-    sData = ''
-    sData += self._createFileHeader()
-    sData += self._createBitmapHeader()
-    sData += self._createPalette()
-    sData += self._createPixels()
-    return sData
+    return ''.join([
+      self._createFileHeader(),
+      self._createBitmapHeader(),
+      self._createPalette(),
+      self._createPixels() ])
 
 
   ##  Evaluates to 8-bit alpha array, first item is top-left corner.
   def alpha( self ):
-    sAlpha = ''
-    for i in range( self._height_n ):
-      for j in range( self._width_n ):
-        if 32 == self._bpp_n:
-          sAlpha += chr( self._pixels_l[ self._height_n - i - 1 ][ j ][ 3 ] )
-        else:
-          if 1 == self._alpha_l[ self._height_n - i - 1 ][ j ]:
-            sAlpha += chr( 0 )
-          else:
-            sAlpha += chr( 0xFF )
-    return sAlpha
+    return _flip( self._alphaLines(), self._width_n )
+
+
+  ##  Evaluates to raw 32-bit data in 'RGBA' fromat, first 4 bytes are
+  ##  top-left corner.
+  def toRaw( self ):
+    aRaw = bytearray( self._width_n * self._height_n * COLOR_SIZE )
+    ##  Color bytes in .bmp file and palette are in 'BGR' order.
+    if self._bpp_n <= 8:
+      sPixels = str( self._pixels_a )
+      lPalette = self._palette_l + [ (0, 0, 0) ] * \
+        (256 - len( self._palette_l ))
+      for i in range( 3 ):
+        sTable = ''.join( chr( gColor[ 2 - i ] ) for gColor in lPalette )
+        aRaw[ i :: COLOR_SIZE ] = sPixels.translate( sTable )
+    else:
+      for i in range( 3 ):
+        aRaw[ i :: COLOR_SIZE ] = self._pixels_a[ 2 - i :: COLOR_SIZE ]
+    aRaw[ 3 :: COLOR_SIZE ] = self._alphaLines()
+    return _flip( str( aRaw ), self._width_n * COLOR_SIZE )
 
 
   def _readBitmapHeader( self, o_reader ):
 
-    assert BITMAPINFOHEADER_SIZE == o_reader.read( '<I' )
-    self._width_n, self._height_n = o_reader.read( '<II' )
+    oHeader = o_reader.readRecord( BITMAPINFOHEADER )
+    assert BITMAPINFOHEADER_SIZE == oHeader.size_n
+    self._width_n = oHeader.width_n
     ##! Height counts alpha channel mask as a separate image.
     self._height_n = self._width_n
     ##  Number of color planes.
-    assert 1 == o_reader.read( '<H' )
-    self._bpp_n = o_reader.read( '<H' )
+    assert 1 == oHeader.planes_n
+    self._bpp_n = oHeader.bpp_n
     assert self._bpp_n in [ 1, 4, 8, 16, 24, 32 ]
-    nCompression = o_reader.read( '<I' )
     ##! Only uncompressed images are supported.
-    assert 0 == nCompression
+    assert 0 == oHeader.compression_n
 
-    nImageSize = o_reader.read( '<I' )
+    nImageSize = oHeader.imageSize_n
     self._lineSize_n = self._lineSize( self._width_n, self._bpp_n )
     ##  Can be 0 for uncompressed bitmaps.
     assert 0 == nImageSize or nImageSize >= self._lineSize_n * self._height_n
 
-    self._resCx_n, self._resCy_n = o_reader.read( '<ii' )
-    self._colors_n = o_reader.read( '<I' )
+    self._resCx_n, self._resCy_n = oHeader.resCx_n, oHeader.resCy_n
+    self._colors_n = oHeader.colors_n
     if 0 == self._colors_n and self._bpp_n <= 8:
       self._colors_n = pow( 2, self._bpp_n )
-    ##  Important colors in palette.
-    o_reader.read( '<I' )
 
 
   def _createBitmapHeader( self, f_ico = False ):
@@ -260,52 +381,24 @@ class Bmp( object ):
   def _readAlpha( self, o_reader ):
 
     ##  Bytes in horizontal line in alpha mask.
-    nAlphaLineSize = (self._width_n / 8) or 1
-    ##! Lines are 4-byte aligned.
-    nAlphaLineSize += self._padding( self._width_n, n_bpp = 1, n_align = 4 )
-    sAlpha = o_reader.readArray( nAlphaLineSize * self._height_n )
-
-    nSide = self._width_n
-    self._alpha_l = [ [ 0 for x in range( nSide ) ] for y in range( nSide ) ]
-    for i in range( nSide ):
-      for j in range( nSide ):
-        nOffsetInBytes = i * nAlphaLineSize + j / 8
-        nOffsetInBits = i * nAlphaLineSize * 8 + j
-        nByte = ord( sAlpha[ nOffsetInBytes ] )
-        if not 0 == (nByte & (1 << (7 - (nOffsetInBits % 8)))):
-          self._alpha_l[ i ][ j ] = 1
-        else:
-          self._alpha_l[ i ][ j ] = 0
+    nAlphaLineSize = self._lineSize( self._width_n, n_bpp = 1 )
+    oAlpha = o_reader.readView( nAlphaLineSize * self._height_n )
+    self._alpha_a = _engine().unpackIndexes( oAlpha, 1, self._width_n,
+      self._height_n, nAlphaLineSize )
 
 
   def _readPixels( self, o_reader ):
 
-    sPixels = o_reader.readArray( self._lineSize_n * self._height_n )
-    nSide = self._width_n
-    self._pixels_l = [ [ 1 for x in range( nSide ) ] for y in range( nSide ) ]
-
-    for i in range( nSide ):
-      for j in range( nSide ):
-        nOffsetInBytes = i * self._lineSize_n + (j * self._bpp_n) / 8
-        nByte = ord( sPixels[ nOffsetInBytes ] )
-        if 4 == self._bpp_n:
-          nOffsetInBits = i * self._lineSize_n * 8 + j * self._bpp_n
-          ##* Offset inside byte.
-          nOffset = nOffsetInBits - nOffsetInBytes * 8
-          if 0 == nOffset:
-            self._pixels_l[ i ][ j ] = (nByte >> 4)
-          if 4 == nOffset:
-            self._pixels_l[ i ][ j ] = (nByte & 0xF)
-        if 8 == self._bpp_n:
-          self._pixels_l[ i ][ j ] = nByte
-        if self._bpp_n >= 24:
-          nRed = ord( sPixels[ nOffsetInBytes + 0 ] )
-          nGreen = ord( sPixels[ nOffsetInBytes + 1 ] )
-          nBlue = ord( sPixels[ nOffsetInBytes + 2 ] )
-          nAlpha = 0
-          if 32 == self._bpp_n:
-            nAlpha = ord( sPixels[ nOffsetInBytes + 3 ] )
-          self._pixels_l[ i ][ j ] = (nRed, nGreen, nBlue, nAlpha)
+    ##! 16-bit images are not supported.
+    assert not 16 == self._bpp_n
+    oPixels = o_reader.readView( self._lineSize_n * self._height_n )
+    with stats.phase( 'decode.pixels' ):
+      if self._bpp_n <= 8:
+        self._pixels_a = _engine().unpackIndexes( oPixels, self._bpp_n,
+          self._width_n, self._height_n, self._lineSize_n )
+      else:
+        self._pixels_a = _engine().unpackColors( oPixels, self._bpp_n,
+          self._width_n, self._height_n, self._lineSize_n )
 
 
   def _defineTransparentColor( self ):
@@ -316,9 +409,8 @@ class Bmp( object ):
           return i
       ##  If not available, search for index that is not used in image.
       lColorsUsed = [ False ] * pow( 2, self._bpp_n )
-      for i in range( self._height_n ):
-        for j in range( self._width_n ):
-          lColorsUsed[ self._pixels_l[ i ][ j ] ] = True
+      for nColor in set( self._pixels_a ):
+        lColorsUsed[ nColor ] = True
       for i in range( len( lColorsUsed ) ):
         if not lColorsUsed[ i ]:
           self._palette_l[ i ] = (0xFF, 0, 0xFF)
@@ -328,6 +420,43 @@ class Bmp( object ):
     return None
 
 
+  ##  Creates alpha mask based on image colors.
+  def _maskFromColors( self ):
+    nTransparent = self._defineTransparentColor()
+    if self._bpp_n <= 8:
+      sTable = ''.join( '\x01' if i == nTransparent else '\x00'
+        for i in range( 256 ) )
+      self._alpha_a = bytearray( str( self._pixels_a ).translate( sTable ) )
+    if 24 == self._bpp_n:
+      self._alpha_a = bytearray( self._width_n * self._height_n )
+      sPixels = str( self._pixels_a )
+      nOffset = sPixels.find( TRANSPARENT_COLOR )
+      while nOffset >= 0:
+        ##  Color can be found across pixels boundary.
+        if 0 == nOffset % COLOR_SIZE:
+          self._alpha_a[ nOffset / COLOR_SIZE ] = 1
+        nOffset = sPixels.find( TRANSPARENT_COLOR, nOffset + 1 )
+    if 32 == self._bpp_n:
+      self._alpha_a = self._alphaMask()
+
+
+  ##  Evaluates to 8-bit alpha of all pixels, lines are in same order as
+  ##  in |self._pixels_a|.
+  def _alphaLines( self ):
+    if 32 == self._bpp_n:
+      return str( self._pixels_a[ COLOR_SIZE - 1 :: COLOR_SIZE ] )
+    sTable = '\xFF\x00' + '\x00' * 254
+    return str( self._alpha_a ).translate( sTable )
+
+
+  ##  Evaluates to alpha mask of 32-bit image, pixels with alpha less
+  ##  than half are transparent.
+  def _alphaMask( self ):
+    sTable = '\x01' * 128 + '\x00' * 128
+    sAlpha = str( self._pixels_a[ COLOR_SIZE - 1 :: COLOR_SIZE ] )
+    return bytearray( sAlpha.translate( sTable ) )
+
+
   def _createFileHeader( self ):
     return struct.pack( '<HIHHI',
       ##  .bmp Magic.
@@ -343,59 +472,26 @@ class Bmp( object ):
 
 
   def _createPalette( self ):
-    sData = ''
-    for gColor in self._palette_l:
-      sData += struct.pack( '!BBBB', * (list( gColor ) + [ 0 ]) )
-    return sData
+    return ''.join( struct.pack( '!BBBB', * (list( gColor ) + [ 0 ]) )
+      for gColor in self._palette_l )
 
 
   def _createPixels( self ):
-    sData = ''
-    for nY in range( self._height_n ):
-      lAccumulated = []
-      for nX in range( self._height_n):
-        if self._bpp_n <= 8:
-          lAccumulated.append( self._pixels_l[ nY ][ nX ] )
-          ##  Collected one or more bytes:
-          if ((len( lAccumulated ) * self._bpp_n) / 8) > 0:
-            nByte = 0
-            for i, nColor in enumerate( lAccumulated ):
-              nByte |= (nColor << (8 - self._bpp_n - self._bpp_n * i))
-            lAccumulated = []
-            sData += chr( nByte )
-        elif 24 == self._bpp_n:
-          gColor = self._pixels_l[ nY ][ nX ]
-          sData += struct.pack( '!BBB', * list( gColor )[ : 3 ] )
-        elif 32 == self._bpp_n:
-          gColor = self._pixels_l[ nY ][ nX ]
-          sData += struct.pack( '!BBBB', * gColor )
-      nPadding = self._padding( self._width_n, self._bpp_n, n_align = 4 )
-      sData += '\x00' * nPadding
+    with stats.phase( 'encode.pixels' ):
+      if self._bpp_n <= 8:
+        sData = _engine().packIndexes( self._pixels_a, self._bpp_n,
+          self._width_n, self._height_n, self._lineSize_n )
+      else:
+        sData = _engine().packColors( self._pixels_a, self._bpp_n,
+          self._width_n, self._height_n, self._lineSize_n )
     assert len( sData ) == self._lineSize_n * self._height_n
     return sData
 
 
   def _createAlpha( self ):
-    sData = ''
-    for nY in range( self._height_n ):
-      lAccumulated = []
-      def accumulatedToData():
-        nByte = 0
-        for i, nAlpha in enumerate( lAccumulated ):
-          if not 0 == nAlpha:
-            nByte |= (1 << (7 - i))
-        return chr( nByte )
-      for nX in range( self._width_n):
-        lAccumulated.append( self._alpha_l[ nY ][ nX ] )
-        ##  Collected one byte?
-        if 8 == len( lAccumulated ):
-          sData += accumulatedToData()
-          lAccumulated = []
-      if lAccumulated:
-        sData += accumulatedToData()
-      nPadding = self._padding( self._width_n, n_bpp = 1, n_align = 4 )
-      sData += '\x00' * nPadding
-    return sData
+    with stats.phase( 'encode.mask' ):
+      return _engine().packIndexes( self._alpha_a, 1, self._width_n,
+        self._height_n, self._lineSize( self._width_n, n_bpp = 1 ) )
 
 
   ##x Number of bytes to add for image line with |n_width| amount of
@@ -409,9 +505,323 @@ class Bmp( object ):
 
 
   def _lineSize( self, n_width, n_bpp ):
-    ##  Bytes in horizontal line in image.
-    nLineSize = ((n_width * n_bpp) / 8) or 1
+    ##  Bytes in horizontal line in image, last byte can be partially used.
+    nLineSize = ((n_width * n_bpp + 7) / 8) or 1
     ##! Lines are 4-byte aligned.
     nLineSize += self._padding( n_width, n_bpp, n_align = 4 )
     return nLineSize
 
+
+##x Evaluates to smallest bits per pixel of bitmap that keeps all visible
+##  pixels of raw 32-bit data |s_data| in 'RGBA' fromat. Distinct pixels
+##  are collected in a single pass, then their colors and alpha are
+##  checked.
+def losslessBpp( s_data ):
+  lColors = set()
+  for sPixel in set( s_data[ i : i + 4 ] for i in range( 0, len( s_data ),
+    COLOR_SIZE ) ):
+    if '\x00' == sPixel[ 3 ]:
+      continue
+    ##  Partially transparent pixels need alpha channel.
+    if '\xFF' != sPixel[ 3 ]:
+      return 32
+    lColors.add( sPixel[ : 3 ] )
+  ##  Violet pixels are transparent in images without alpha channel.
+  if TRANSPARENT_COLOR in lColors:
+    return 32
+  for nBpp in [ 1, 4, 8 ]:
+    ##  Palette color is reserved for transparent pixels, see |quantize|.
+    if len( lColors ) < pow( 2, nBpp ):
+      return nBpp
+  return 24
+
+
+##x Reduces colors of |m_counts| histogram to |n_colors| by median cut:
+##  group of colors with widest range of some component is split in two
+##  at weighted median of that component. Evaluates to |(palette,
+##  indexes)|, indexes of palette colors by original color.
+def _medianCut( m_counts, n_colors ):
+  ##  Groups are |(range, component, colors)| of widest component.
+  def group( l_colors ):
+    lRanges = []
+    for j in range( 3 ):
+      lValues = [ g[ j ] for g, _ in l_colors ]
+      lRanges.append( max( lValues ) - min( lValues ) )
+    nRange = max( lRanges )
+    return (nRange, lRanges.index( nRange ), l_colors)
+  lGroups = [ group( sorted( m_counts.items() ) ) ]
+  while len( lGroups ) < n_colors:
+    i = max( range( len( lGroups ) ), key = lambda n: lGroups[ n ][ 0 ] )
+    nRange, j, lGroup = lGroups[ i ]
+    ##  All colors in every group are same?
+    if 0 == nRange:
+      break
+    lGroup = sorted( lGroup, key = lambda x: x[ 0 ][ j ] )
+    nHalf = sum( n for _, n in lGroup ) / 2.0
+    nSum = 0
+    for k, (_, n) in enumerate( lGroup ):
+      nSum += n
+      if nSum >= nHalf:
+        break
+    ##  Both halves must not be empty.
+    k = min( k, len( lGroup ) - 2 ) + 1
+    lGroups[ i : i + 1 ] = [ group( lGroup[ : k ] ), group( lGroup[ k : ] ) ]
+  lGroups = [ g[ 2 ] for g in lGroups ]
+  lPalette = []
+  mIndexes = {}
+  for i, lGroup in enumerate( lGroups ):
+    nTotal = sum( n for _, n in lGroup )
+    lPalette.append( tuple( int( sum( g[ j ] * n for g, n in lGroup ) /
+      float( nTotal ) + 0.5 ) for j in range( 3 ) ) )
+    for gColor, _ in lGroup:
+      mIndexes[ gColor ] = i
+  return lPalette, mIndexes
+
+
+##x Evaluates to palette indexes of |l_colors| after Floyd-Steinberg
+##  dithering: error of each pixel is spread to right and next line
+##  pixels. Transparent pixels are |n_transparent| and don't spread
+##  error.
+def _dither( l_colors, l_transparent, l_palette, n_transparent, n_width ):
+  ##  Nearest palette colors are cached for 8x8x8 cells of colors, so
+  ##  search is done at most once per cell.
+  mNearest = {}
+  def nearest( g_color ):
+    nB, nG, nR = g_color
+    nCell = (nB >> 3) << 10 | (nG >> 3) << 5 | nR >> 3
+    nIndex = mNearest.get( nCell )
+    if nIndex is None:
+      nB, nG, nR = nB | 4, nG | 4, nR | 4
+      nBest = None
+      for i, (b, g, r) in enumerate( l_palette ):
+        nDistance = (nB - b) * (nB - b) + (nG - g) * (nG - g) + \
+          (nR - r) * (nR - r)
+        if nBest is None or nDistance < nBest:
+          nBest = nDistance
+          nIndex = i
+      mNearest[ nCell ] = nIndex
+    return nIndex
+  lIndexes = [ n_transparent ] * len( l_colors )
+  ##  Errors for current and next line, 3 components per pixel, with one
+  ##  pixel margin at each side.
+  lError = [ 0 ] * ((n_width + 2) * 3)
+  lErrorNext = [ 0 ] * ((n_width + 2) * 3)
+  for nStart in range( 0, len( l_colors ), n_width ):
+    for x in range( n_width ):
+      i = nStart + x
+      if l_transparent[ i ]:
+        continue
+      nBase = (x + 1) * 3
+      gColor = tuple( min( 255, max( 0, c + (lError[ nBase + j ] >> 4) ) )
+        for j, c in enumerate( l_colors[ i ] ) )
+      nIndex = nearest( gColor )
+      lIndexes[ i ] = nIndex
+      for j in range( 3 ):
+        nError = gColor[ j ] - l_palette[ nIndex ][ j ]
+        lError[ nBase + 3 + j ] += nError * 7
+        lErrorNext[ nBase - 3 + j ] += nError * 3
+        lErrorNext[ nBase + j ] += nError * 5
+        lErrorNext[ nBase + 3 + j ] += nError
+    lError = lErrorNext
+    lErrorNext = [ 0 ] * ((n_width + 2) * 3)
+  return lIndexes
+
+
+##x Reverses order of |n_stride| bytes long lines in |s_data|.
+def _flip( s_data, n_stride ):
+  return ''.join( reversed( [ s_data[ i : i + n_stride ]
+    for i in range( 0, len( s_data ), n_stride ) ] ) )
+
+
+##  Pure Python pixel codec, used if NumPy is not available.
+class EnginePython( object ):
+
+
+  ##x Unpacks |n_height| lines of |n_bpp| <= 8 bits per pixel data
+  ##  |o_data| into one byte per pixel.
+  @staticmethod
+  def unpackIndexes( o_data, n_bpp, n_width, n_height, n_lineSize ):
+    if 8 == n_bpp:
+      sPixels = str( o_data )
+      nPerLine = n_lineSize
+    else:
+      ##  Each hex digit is 4 pixels of 1-bit data or 1 pixel of 4-bit
+      ##  data, 1-bit data is converted to binary digits.
+      sPixels = str( o_data ).encode( 'hex' )
+      if 1 == n_bpp and sPixels:
+        sPixels = format( int( sPixels, 16 ), '0{0}b'.format(
+          len( sPixels ) * 4 ) )
+      sPixels = sPixels.translate( _DIGIT_TO_VALUE )
+      nPerLine = n_lineSize * 8 / n_bpp
+    return bytearray( ''.join( sPixels[ i : i + n_width ]
+      for i in range( 0, nPerLine * n_height, nPerLine ) ) )
+
+
+  ##x Packs one byte per pixel |a_pixels| into |n_height| lines of |n_bpp|
+  ##  <= 8 bits per pixel data, each line is |n_lineSize| bytes.
+  @staticmethod
+  def packIndexes( a_pixels, n_bpp, n_width, n_height, n_lineSize ):
+    if 8 == n_bpp:
+      sPixels = str( a_pixels )
+      sPadding = '\x00' * (n_lineSize - n_width)
+    else:
+      ##  Reverse of |unpackIndexes|: each pixel is converted to binary or
+      ##  hex digit and lines are padded with zero digits.
+      sPixels = str( a_pixels ).translate( _VALUE_TO_DIGIT[ n_bpp ] )
+      sPadding = '0' * (n_lineSize * 8 / n_bpp - n_width)
+    sPixels = ''.join( sPixels[ i : i + n_width ] + sPadding
+      for i in range( 0, n_width * n_height, n_width ) )
+    if 8 == n_bpp:
+      return sPixels
+    if 1 == n_bpp and sPixels:
+      sPixels = '{0:0{1}x}'.format( int( sPixels, 2 ), len( sPixels ) / 4 )
+    return sPixels.decode( 'hex' )
+
+
+  ##x Unpacks |n_height| lines of 24 or 32 bits per pixel data |o_data|
+  ##  into |COLOR_SIZE| bytes per pixel.
+  @staticmethod
+  def unpackColors( o_data, n_bpp, n_width, n_height, n_lineSize ):
+    if 32 == n_bpp:
+      ##  Lines of 32-bit image don't need padding.
+      return bytearray( o_data )
+    aData = bytearray( o_data )
+    nStride = n_width * COLOR_SIZE
+    aPixels = bytearray( nStride * n_height )
+    for nY in range( n_height ):
+      nSrc = nY * n_lineSize
+      nDst = nY * nStride
+      for i in range( 3 ):
+        aPixels[ nDst + i : nDst + nStride : COLOR_SIZE ] = \
+          aData[ nSrc + i : nSrc + n_width * 3 : 3 ]
+    return aPixels
+
+
+  ##x Packs |COLOR_SIZE| bytes per pixel |a_pixels| into |n_height| lines
+  ##  of 24 or 32 bits per pixel data, each line is |n_lineSize| bytes.
+  @staticmethod
+  def packColors( a_pixels, n_bpp, n_width, n_height, n_lineSize ):
+    if 32 == n_bpp:
+      return str( a_pixels )
+    aData = bytearray( n_lineSize * n_height )
+    nStride = n_width * COLOR_SIZE
+    for nY in range( n_height ):
+      nSrc = nY * nStride
+      nDst = nY * n_lineSize
+      for i in range( 3 ):
+        aData[ nDst + i : nDst + n_width * 3 : 3 ] = \
+          a_pixels[ nSrc + i : nSrc + nStride : COLOR_SIZE ]
+    return str( aData )
+
+
+##  Vectorized pixel codec, decodes and encodes whole images via NumPy
+##  arrays.
+class EngineNumpy( EnginePython ):
+
+
+  @staticmethod
+  def unpackIndexes( o_data, n_bpp, n_width, n_height, n_lineSize ):
+    aData = numpy.frombuffer( o_data, numpy.uint8 )
+    aData = aData.reshape( n_height, n_lineSize )
+    nPerByte = 8 / n_bpp
+    ##  Shift of each pixel inside byte, first pixel is most significant.
+    aShifts = numpy.arange( 8 - n_bpp, -1, -n_bpp, dtype = numpy.uint8 )
+    aPixels = (aData[ :, :, None ] >> aShifts) & ((1 << n_bpp) - 1)
+    aPixels = aPixels.reshape( n_height, n_lineSize * nPerByte )
+    return bytearray( aPixels[ :, : n_width ].tostring() )
+
+
+  @staticmethod
+  def packIndexes( a_pixels, n_bpp, n_width, n_height, n_lineSize ):
+    aPixels = numpy.frombuffer( a_pixels, numpy.uint8 )
+    aPixels = aPixels.reshape( n_height, n_width )
+    nPerByte = 8 / n_bpp
+    nUsed = (n_width + nPerByte - 1) / nPerByte
+    aUsed = numpy.zeros( (n_height, nUsed * nPerByte), numpy.uint8 )
+    aUsed[ :, : n_width ] = aPixels
+    aShifts = numpy.arange( 8 - n_bpp, -1, -n_bpp, dtype = numpy.uint8 )
+    aUsed = aUsed.reshape( n_height, nUsed, nPerByte ) << aShifts
+    aData = numpy.zeros( (n_height, n_lineSize), numpy.uint8 )
+    aData[ :, : nUsed ] = numpy.bitwise_or.reduce( aUsed, axis = 2 )
+    return aData.tostring()
+
+
+  @staticmethod
+  def unpackColors( o_data, n_bpp, n_width, n_height, n_lineSize ):
+    if 32 == n_bpp:
+      return bytearray( o_data )
+    aData = numpy.frombuffer( o_data, numpy.uint8 )
+    aData = aData.reshape( n_height, n_lineSize )
+    aPixels = numpy.zeros( (n_height, n_width, COLOR_SIZE), numpy.uint8 )
+    aPixels[ :, :, : 3 ] = aData[ :, : n_width * 3 ].reshape( n_height,
+      n_width, 3 )
+    return bytearray( aPixels.tostring() )
+
+
+  @staticmethod
+  def packColors( a_pixels, n_bpp, n_width, n_height, n_lineSize ):
+    if 32 == n_bpp:
+      return str( a_pixels )
+    aPixels = numpy.frombuffer( a_pixels, numpy.uint8 )
+    aPixels = aPixels.reshape( n_height, n_width, COLOR_SIZE )
+    aData = numpy.zeros( (n_height, n_lineSize), numpy.uint8 )
+    aData[ :, : n_width * 3 ] = aPixels[ :, :, : 3 ].reshape( n_height,
+      n_width * 3 )
+    return aData.tostring()
+
+
+##  Pixel codecs by name, codec can be used only if it's name is in
+##  |engines|.
+ENGINES = { 'python': EnginePython, 'numpy': EngineNumpy }
+##  Selected pixel codec, |None| if not selected yet.
+_engine_o = None
+
+
+##x Evaluates to names of available pixel codecs.
+def engines():
+  return sorted( s for s in ENGINES if 'numpy' != s or _numpy() )
+
+
+##x Selects pixel codec by name from |engines|.
+def setEngine( s_name ):
+  global _engine_o
+  assert s_name in engines(), "engine not available: {0}".format( s_name )
+  _engine_o = ENGINES[ s_name ]
+
+
+##x Evaluates to name of selected pixel codec.
+def engine():
+  for sName, oEngine in ENGINES.items():
+    if oEngine is _engine():
+      return sName
+
+
+##  Evaluates to selected pixel codec, by default fastest available one.
+def _engine():
+  global _engine_o
+  if _engine_o is None:
+    _engine_o = EngineNumpy if _numpy() else EnginePython
+  return _engine_o
+
+
+##  Evaluates to |numpy| module or |False| if it's not available.
+def _numpy():
+  global numpy
+  if numpy is None:
+    try:
+      import numpy
+    except ImportError:
+      numpy = False
+  return numpy
+
+
+##  Translation tables for |EnginePython|: binary or hex digit to it's
+##  value and value to digit for 1 and 4 bits per pixel. For 1-bit data
+##  any non-zero value is 1.
+_DIGIT_TO_VALUE = ''.join( chr( int( chr( i ), 16 ) )
+  if chr( i ) in '0123456789abcdef' else '\x00' for i in range( 256 ) )
+_VALUE_TO_DIGIT = {
+  1: '0' + '1' * 255,
+  4: ''.join( '{0:x}'.format( i & 0xF ) for i in range( 256 ) ),
+}
+
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico cache of decoded icons.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+# Icons that are opened again are taken from memory instead of being read
+# and decoded. Cached icons are never returned as is: each call evaluates
+# to a copy, so callers can modify it:
+#   from pyico import cache
+#   oIco = cache.open( 'favicon.ico' )
+
+import collections
+import hashlib
+import os
+import threading
+
+import pyico
+
+
+##  Default memory budget, in bytes.
+BUDGET = 64 * 1024 * 1024
+
+
+class Cache( object ):
+
+
+  ##x Least recently used icons are evicted if size of all cached icons
+  ##  exceeds |n_budget| bytes.
+  def __init__( self, n_budget = BUDGET ):
+    self.budget_n = n_budget
+    self.hits_n = 0
+    self.misses_n = 0
+    self.evictions_n = 0
+    ##  |(ico, size)| tuples by key, least recently used first.
+    self._entries_m = collections.OrderedDict()
+    self._size_n = 0
+    self._lock_o = threading.Lock()
+
+
+  ##x Same as |pyico.open|. Cached icon is used if file path,
+  ##  modification time and size are not changed.
+  def open( self, fp ):
+    sPath = os.path.abspath( fp )
+    oStat = os.stat( sPath )
+    gKey = ('file', sPath, oStat.st_mtime, oStat.st_size)
+    oIco = self._get( gKey )
+    if oIco is None:
+      oIco = pyico.open( fp )
+      self._put( gKey, oIco, oStat.st_size )
+    return oIco.copy()
+
+
+  ##x Same as |pyico.load|. Cached icon is used if data has same hash.
+  def load( self, o_data ):
+    gKey = ('data', hashlib.sha1( o_data ).digest())
+    oIco = self._get( gKey )
+    if oIco is None:
+      oIco = pyico.load( o_data )
+      self._put( gKey, oIco, len( o_data ) )
+    return oIco.copy()
+
+
+  ##  Evaluates to size of all cached icons, in bytes.
+  def size( self ):
+    return self._size_n
+
+
+  def clear( self ):
+    with self._lock_o:
+      self._entries_m.clear()
+      self._size_n = 0
+
+
+  ##x Evaluates to dict of cache statistics.
+  def stats( self ):
+    with self._lock_o:
+      return {
+        'hits': self.hits_n,
+        'misses': self.misses_n,
+        'evictions': self.evictions_n,
+        'entries': len( self._entries_m ),
+        'size': self._size_n,
+        'budget': self.budget_n,
+      }
+
+
+  def _get( self, g_key ):
+    with self._lock_o:
+      gEntry = self._entries_m.pop( g_key, None )
+      if gEntry is None:
+        self.misses_n += 1
+        return None
+      ##  Move to the end as most recently used.
+      self._entries_m[ g_key ] = gEntry
+      self.hits_n += 1
+      return gEntry[ 0 ]
+
+
+  ##  |n_data| is size of icon data that is referenced by decoded images.
+  def _put( self, g_key, o_ico, n_data ):
+    nSize = n_data + sum( len( o._data_s ) for o in o_ico.images_l )
+    if nSize > self.budget_n:
+      return
+    with self._lock_o:
+      ##  Same icon can be decoded by other thread meanwhile.
+      gEntry = self._entries_m.pop( g_key, None )
+      if gEntry is not None:
+        self._size_n -= gEntry[ 1 ]
+      self._entries_m[ g_key ] = (o_ico, nSize)
+      self._size_n += nSize
+      while self._size_n > self.budget_n:
+        _, (_, nEvicted) = self._entries_m.popitem( last = False )
+        self._size_n -= nEvicted
+        self.evictions_n += 1
+
+
+_cache_o = None
+_cacheLock_o = threading.Lock()
+
+
+##x Sets cache that is used by module functions.
+def setCache( o_cache ):
+  global _cache_o
+  _cache_o = o_cache
+
+
+##x Evaluates to cache used by module functions, it's created on first use.
+def cache():
+  global _cache_o
+  with _cacheLock_o:
+    if _cache_o is None:
+      _cache_o = Cache()
+    return _cache_o
+
+
+##x Same as |Cache.open| for default cache.
+def open( fp ):
+  return cache().open( fp )
+
+
+##x Same as |Cache.load| for default cache.
+def load( o_data ):
+  return cache().load( o_data )
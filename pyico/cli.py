@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico command-line batch converter.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+import argparse
+import glob
+import itertools
+import multiprocessing
+import os
+import sys
+
+import pyico
+
+
+##  Extensions of files that can be converted.
+EXTENSIONS = [ '.ico', '.bmp' ]
+
+
+##x Converts |.ico| file to |.bmp| and |.png| files, one per image, or
+##  |.bmp| file to |.ico| file. Files are written into |sDirOut|, default
+##  is directory of file, that is created if needed. Runs in worker
+##  process, so errors are reported as result instead of exception.
+def convert( g_task ):
+  sPath, sDirOut, nBpp, fDither = g_task
+  try:
+    sName, sExt = os.path.splitext( os.path.basename( sPath ) )
+    sDirOut = sDirOut or os.path.dirname( sPath )
+    if sDirOut and not os.path.isdir( sDirOut ):
+      try:
+        os.makedirs( sDirOut )
+      ##  Other worker can create it meanwhile.
+      except OSError:
+        if not os.path.isdir( sDirOut ):
+          raise
+    lOut = []
+    if '.ico' == sExt.lower():
+      oIco = pyico.open( sPath, f_lazy = True )
+      ##  Icon can have images of same size and bits per pixel, so index
+      ##  is included into name.
+      for i, oImage in enumerate( oIco.images_l ):
+        sOut = os.path.join( sDirOut, "{0}_{1}_{2}x{3}x{4}.{5}".format( sName,
+          i, oImage.width_n, oImage.height_n, oImage.bpp_n,
+          'png' if oImage.png_f else 'bmp' ) )
+        with open( sOut, 'wb' ) as oFile:
+          oFile.write( oImage.data_s )
+        lOut.append( sOut )
+    else:
+      oIco = pyico.Ico()
+      with open( sPath, 'rb' ) as oFile:
+        oIco.addFromBmp( oFile.read(), nBpp, fDither )
+      sOut = os.path.join( sDirOut, sName + '.ico' )
+      with open( sOut, 'wb' ) as oFile:
+        oIco.save( oFile )
+      lOut.append( sOut )
+    return sPath, lOut, None
+  except Exception as oError:
+    sError = type( oError ).__name__
+    if str( oError ):
+      sError += ": " + str( oError )
+    return sPath, [], sError
+
+
+##x Expands files, directories and glob patterns into list of
+##  |(file, subdirectory)| tuples for files that can be converted.
+##  Subdirectory is relative path of file's directory inside directory
+##  that is walked, '' for files that are specified directly.
+def collect( l_paths ):
+  lFiles = []
+  for sPattern in l_paths:
+    for sPath in sorted( glob.glob( sPattern ) ) or [ sPattern ]:
+      if os.path.isdir( sPath ):
+        for sDir, lDirs, lNames in os.walk( sPath ):
+          lDirs.sort()
+          sSubdir = os.path.relpath( sDir, sPath )
+          if os.curdir == sSubdir:
+            sSubdir = ''
+          for sName in sorted( lNames ):
+            if os.path.splitext( sName )[ 1 ].lower() in EXTENSIONS:
+              lFiles.append( (os.path.join( sDir, sName ), sSubdir) )
+      else:
+        lFiles.append( (sPath, '') )
+  return lFiles
+
+
+def main( l_args = None ):
+  oParser = argparse.ArgumentParser( prog = 'pyico',
+    description = "Converts .ico files to .bmp/.png and .bmp to .ico." )
+  oParser.add_argument( 'paths', nargs = '+', metavar = 'PATH',
+    help = "file, directory or glob pattern" )
+  oParser.add_argument( '-o', '--output', metavar = 'DIR',
+    help = "output directory, default is directory of each file" )
+  oParser.add_argument( '-b', '--bpp', type = int,
+    help = "bits per pixel for .bmp files converted to .ico" )
+  oParser.add_argument( '-d', '--dither', action = 'store_true',
+    help = "dither colors if they are reduced for --bpp" )
+  oParser.add_argument( '-j', '--jobs', type = int,
+    default = multiprocessing.cpu_count(),
+    help = "number of worker processes (default: %(default)s)" )
+  oParser.add_argument( '-c', '--chunk', type = int,
+    help = "number of files sent to worker at once" )
+  oParser.add_argument( '-q', '--quiet', action = 'store_true',
+    help = "report failed files only" )
+  oArgs = oParser.parse_args( l_args )
+
+  ##  Subdirectories of walked directories are mirrored in output
+  ##  directory. Files that are still written to same output, like
+  ##  'a/foo.bmp' and 'b/foo.bmp' specified directly, are not converted.
+  lTasks = []
+  lCollisions = []
+  mOutputs = {}
+  for sPath, sSubdir in collect( oArgs.paths ):
+    sDirOut = None
+    if oArgs.output:
+      sDirOut = os.path.join( oArgs.output, sSubdir )
+    gOutput = (os.path.normcase( os.path.abspath( sDirOut or
+      os.path.dirname( sPath ) ) ), os.path.basename( sPath ))
+    if gOutput in mOutputs:
+      lCollisions.append( (sPath, "output collides with {0}".format(
+        mOutputs[ gOutput ] )) )
+      continue
+    mOutputs[ gOutput ] = sPath
+    lTasks.append( (sPath, sDirOut, oArgs.bpp, oArgs.dither) )
+  nTotal = len( lTasks ) + len( lCollisions )
+  nChunk = oArgs.chunk or max( 1, len( lTasks ) / (oArgs.jobs * 4) )
+
+  oPool = None
+  if oArgs.jobs > 1 and len( lTasks ) > 1:
+    oPool = multiprocessing.Pool( oArgs.jobs )
+    iResults = oPool.imap_unordered( convert, lTasks, chunksize = nChunk )
+  else:
+    iResults = ( convert( g ) for g in lTasks )
+
+  nFailed = 0
+  try:
+    lCollisions = [ (sPath, [], sError) for sPath, sError in lCollisions ]
+    for i, (sPath, lOut, sError) in enumerate( itertools.chain( lCollisions,
+      iResults ) ):
+      if sError:
+        nFailed += 1
+        sys.stderr.write( "[{0}/{1}] {2}: {3}\n".format( i + 1, nTotal,
+          sPath, sError ) )
+      elif not oArgs.quiet:
+        sys.stderr.write( "[{0}/{1}] {2}: {3}\n".format( i + 1, nTotal,
+          sPath, ", ".join( lOut ) ) )
+    if oPool:
+      oPool.close()
+  finally:
+    if oPool:
+      oPool.terminate()
+      oPool.join()
+
+  sys.stderr.write( "{0} converted, {1} failed\n".format(
+    nTotal - nFailed, nFailed ) )
+  return 1 if nFailed else 0
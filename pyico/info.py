@@ -6,23 +6,53 @@
 # See LICENSE for details.
 
 import os
-import pkg_resources
+import sys
+import types
 
 NAME_SHORT = "pyico"
 VER_MAJOR = 0
 VER_MINOR = 1
-try:
-  VER_TXT = pkg_resources.require( NAME_SHORT )[ 0 ].version
-##  Installing via 'setup.py develop'?
-except pkg_resources.DistributionNotFound:
-  VER_BUILD = 0
-  VER_TXT = ".".join( map( str, [ VER_MAJOR, VER_MINOR, VER_BUILD ] ) )
 DIR_THIS = os.path.dirname( os.path.abspath( __file__ ) )
 NAME_FULL = "Python XCF"
-DESCR = """
+
+##  Version of installed package, evaluated by |version|.
+_version_s = None
+
+
+##x Evaluates to version of installed package. |pkg_resources| scans all
+##  installed distributions on import, so it's imported on first use.
+def version():
+  global _version_s
+  if _version_s is None:
+    import pkg_resources
+    try:
+      _version_s = pkg_resources.require( NAME_SHORT )[ 0 ].version
+    ##  Installing via 'setup.py develop'?
+    except pkg_resources.DistributionNotFound:
+      VER_BUILD = 0
+      _version_s = ".".join( map( str, [ VER_MAJOR, VER_MINOR, VER_BUILD ] ) )
+  return _version_s
+
+
+def description():
+  return """
 {s_name_short} v. {s_ver_txt}\\n\\n
 A simple python lib that can read and write windows .ico files.
 """.replace( '\n', '' ).replace( '\\n', '\n' ).strip().format(
-  s_name_short = NAME_SHORT,
-  s_ver_txt = VER_TXT )
+    s_name_short = NAME_SHORT,
+    s_ver_txt = version() )
+
+
+##  |VER_TXT| and |DESCR| are evaluated on first access.
+class _Module( types.ModuleType ):
+
+
+  VER_TXT = property( lambda self: version() )
+  DESCR = property( lambda self: description() )
+
 
+_module_o = _Module( __name__ )
+_module_o.__dict__.update( globals() )
+##  Functions refer to globals of this module, that must not be collected.
+_module_o._original_o = sys.modules[ __name__ ]
+sys.modules[ __name__ ] = _module_o
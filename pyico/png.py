@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico PNG support.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+import struct
+import zlib
+
+import binary
+import bmp
+
+
+##  .png files and PNG images inside .ico start with this signature.
+SIGNATURE = '\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'
+##  Default zlib compression level.
+LEVEL = 6
+##  Contents of 'IHDR' chunk that is always first.
+IHDR = binary.record( 'IHDR', '>IIBBBBB', [
+  'width_n',
+  'height_n',
+  ##  Bits per sample.
+  'depth_n',
+  'colorType_n',
+  'compression_n',
+  'filter_n',
+  'interlace_n',
+])
+##  Color type for 8-bit 'RGBA' samples.
+COLOR_RGBA = 6
+##  Samples per pixel by color type.
+SAMPLES = { 0: 1, 2: 3, 3: 1, 4: 2, 6: 4 }
+FILTER_UP = '\x02'
+
+
+##x Evaluates to PNG file content for raw 32-bit data in 'RGBA' fromat,
+##  first 4 bytes are top-left corner. |n_level| is zlib compression
+##  level.
+def encode( s_data, n_width, n_height, n_level = LEVEL ):
+  nStride = n_width * 4
+  s_data = s_data[ : nStride * n_height ]
+  ##  'Up' filter: each byte is replaced with difference from byte above
+  ##  it, that compresses much better for most images.
+  sData = _subtract( s_data, '\x00' * nStride + s_data[ : -nStride ] )
+  ##  Each line starts with filter type.
+  sLines = ''.join( FILTER_UP + sData[ i : i + nStride ]
+    for i in range( 0, len( sData ), nStride ) )
+  return ''.join([
+    SIGNATURE,
+    _chunk( 'IHDR', IHDR.STRUCT.pack( n_width, n_height, 8, COLOR_RGBA, 0,
+      0, 0 ) ),
+    _chunk( 'IDAT', zlib.compress( sLines, n_level ) ),
+    _chunk( 'IEND', '' ) ])
+
+
+##x Decodes PNG file content |s_data|, that can be a string or any object
+##  supporting buffer protocol. Evaluates to |(width, height, data)|,
+##  data is raw 32-bit data in 'RGBA' fromat, first 4 bytes are top-left
+##  corner. Image data is decompressed and unfiltered line by line, as it
+##  is read.
+##! Interlaced images are not supported. Transparent color of grayscale
+##  and truecolor images without alpha is ignored.
+def decode( s_data ):
+  oReader = binary.Reader( s_data )
+  assert SIGNATURE == oReader.readArray( len( SIGNATURE ) )
+  oHeader = None
+  sPalette = ''
+  sTransparency = ''
+  oDecompressor = zlib.decompressobj()
+  lLines = []
+  sPending = ''
+  while True:
+    nSize, sType = oReader.read( '>I4s' )
+    oChunk = oReader.readView( nSize )
+    ##  Skip CRC.
+    oReader.read( '>I' )
+    if 'IHDR' == sType:
+      oHeader = binary.Reader( oChunk ).readRecord( IHDR )
+      assert 0 == oHeader.compression_n and 0 == oHeader.filter_n
+      assert 0 == oHeader.interlace_n, "interlaced PNG is not supported"
+      assert oHeader.colorType_n in SAMPLES
+      nBpp = bpp( oHeader )
+      ##  Bytes per line and bytes per complete pixel used by filters.
+      nStride = (oHeader.width_n * nBpp + 7) / 8
+      nPixel = max( 1, nBpp / 8 )
+      sPrev = '\x00' * nStride
+    elif 'PLTE' == sType:
+      sPalette = str( oChunk )
+    elif 'tRNS' == sType:
+      sTransparency = str( oChunk )
+    elif 'IDAT' == sType:
+      sPending += oDecompressor.decompress( oChunk )
+      nOffset = 0
+      while len( sPending ) - nOffset > nStride and \
+        len( lLines ) < oHeader.height_n:
+        sPrev = _unfilter( sPending[ nOffset ],
+          sPending[ nOffset + 1 : nOffset + 1 + nStride ], sPrev, nPixel )
+        lLines.append( sPrev )
+        nOffset += nStride + 1
+      sPending = sPending[ nOffset : ]
+    elif 'IEND' == sType:
+      break
+  sPending += oDecompressor.flush()
+  for i in range( 0, len( sPending ) - nStride, nStride + 1 ):
+    if len( lLines ) >= oHeader.height_n:
+      break
+    sPrev = _unfilter( sPending[ i ], sPending[ i + 1 : i + 1 + nStride ],
+      sPrev, nPixel )
+    lLines.append( sPrev )
+  assert oHeader.height_n == len( lLines ), "PNG data is truncated"
+  return (oHeader.width_n, oHeader.height_n, _toRaw( oHeader, lLines,
+    sPalette, sTransparency ))
+
+
+##x Evaluates to |IHDR| record of PNG file content |s_data|.
+def header( s_data ):
+  oReader = binary.Reader( s_data )
+  assert SIGNATURE == oReader.readArray( len( SIGNATURE ) )
+  nSize, sType = oReader.read( '>I4s' )
+  assert 'IHDR' == sType and IHDR.STRUCT.size == nSize
+  return oReader.readRecord( IHDR )
+
+
+##x Evaluates to bits per pixel of image with |IHDR| record |o_header|.
+def bpp( o_header ):
+  return o_header.depth_n * SAMPLES[ o_header.colorType_n ]
+
+
+def _chunk( s_type, s_data ):
+  nCrc = zlib.crc32( s_type + s_data ) & 0xFFFFFFFF
+  return ''.join([
+    struct.pack( '>I', len( s_data ) ),
+    s_type,
+    s_data,
+    struct.pack( '>I', nCrc ) ])
+
+
+##x Converts unfiltered |l_lines| of image with |o_header| into raw 32-bit
+##  data in 'RGBA' fromat.
+def _toRaw( o_header, l_lines, s_palette, s_transparency ):
+  nWidth = o_header.width_n
+  nHeight = o_header.height_n
+  nDepth = o_header.depth_n
+  nType = o_header.colorType_n
+  sData = ''.join( l_lines )
+  ##  Only most significant byte of 16-bit samples is used.
+  if 16 == nDepth:
+    sData = sData[ : : 2 ]
+    nDepth = 8
+  nSamples = SAMPLES[ nType ]
+  aRaw = bytearray( '\xFF' * (nWidth * nHeight * 4) )
+  if nDepth < 8:
+    ##  Unpack to one byte per sample, grayscale is scaled to 8 bits.
+    sData = _unpack( sData, nDepth, nWidth, nHeight )
+    if 0 == nType:
+      nMax = (1 << nDepth) - 1
+      sData = sData.translate( ''.join( chr( i * 255 / nMax if i <= nMax
+        else 0 ) for i in range( 256 ) ) )
+  if 3 == nType:
+    ##  Colors missing from palette and transparency are black and opaque.
+    sPalette = s_palette + '\x00' * (768 - len( s_palette ))
+    sAlpha = s_transparency + '\xFF' * (256 - len( s_transparency ))
+    for i in range( 3 ):
+      aRaw[ i : : 4 ] = sData.translate( sPalette[ i : : 3 ] )
+    aRaw[ 3 : : 4 ] = sData.translate( sAlpha )
+  elif nType in [ 0, 4 ]:
+    sGray = sData[ : : nSamples ]
+    for i in range( 3 ):
+      aRaw[ i : : 4 ] = sGray
+    if 4 == nType:
+      aRaw[ 3 : : 4 ] = sData[ 1 : : 2 ]
+  else:
+    for i in range( nSamples ):
+      aRaw[ i : : 4 ] = sData[ i : : nSamples ]
+  return str( aRaw )
+
+
+##x Unpacks lines of |n_depth| < 8 bits per sample |s_data| into one byte
+##  per sample.
+def _unpack( s_data, n_depth, n_width, n_height ):
+  nStride = (n_width * n_depth + 7) / 8
+  if 2 != n_depth:
+    return str( bmp.EnginePython.unpackIndexes( s_data, n_depth, n_width,
+      n_height, nStride ) )
+  ##  Each 2-bit sample is a pair of 1-bit ones.
+  aBits = bmp.EnginePython.unpackIndexes( s_data, 1, n_width * 2, n_height,
+    nStride )
+  return str( bytearray( (a << 1) | b
+    for a, b in zip( aBits[ 0 : : 2 ], aBits[ 1 : : 2 ] ) ) )
+
+
+##x Reverses PNG filter of type |s_type| for line |s_line|, |s_prev| is
+##  previous unfiltered line and |n_pixel| is bytes per pixel.
+def _unfilter( s_type, s_line, s_prev, n_pixel ):
+  nLen = len( s_line )
+  if '\x00' == s_type:
+    return s_line
+  if '\x01' == s_type:
+    ##  'Sub': each byte is a sum of all bytes |n_pixel| apart that are
+    ##  before it, evaluated by doubling the distance.
+    nLine = _toInt( s_line )
+    nDistance = n_pixel
+    while nDistance < nLen:
+      nLine = _add( nLine, nLine >> (nDistance * 8), nLen )
+      nDistance *= 2
+    return _fromInt( nLine, nLen )
+  if FILTER_UP == s_type:
+    return _fromInt( _add( _toInt( s_line ), _toInt( s_prev ), nLen ), nLen )
+  aLine = bytearray( s_line )
+  aPrev = bytearray( s_prev )
+  if '\x03' == s_type:
+    ##  'Average' of left and above bytes.
+    for i in range( n_pixel ):
+      aLine[ i ] = (aLine[ i ] + (aPrev[ i ] >> 1)) & 0xFF
+    for i in range( n_pixel, nLen ):
+      aLine[ i ] = (aLine[ i ] + ((aLine[ i - n_pixel ] + aPrev[ i ]) >> 1)) \
+        & 0xFF
+    return str( aLine )
+  assert '\x04' == s_type, "unknown PNG filter"
+  ##  'Paeth': left, above or upper left byte that is closest to their
+  ##  linear prediction.
+  for i in range( nLen ):
+    if i < n_pixel:
+      a = 0
+      c = 0
+    else:
+      a = aLine[ i - n_pixel ]
+      c = aPrev[ i - n_pixel ]
+    b = aPrev[ i ]
+    nA = abs( b - c )
+    nB = abs( a - c )
+    nC = abs( a + b - c - c )
+    if nA <= nB and nA <= nC:
+      nPredicted = a
+    elif nB <= nC:
+      nPredicted = b
+    else:
+      nPredicted = c
+    aLine[ i ] = (aLine[ i ] + nPredicted) & 0xFF
+  return str( aLine )
+
+
+##  Bytes are processed all at once as a single long integer, first byte
+##  is most significant. High bit of each byte is handled separately, so
+##  carries and borrows don't cross bytes.
+def _toInt( s_data ):
+  return int( s_data.encode( 'hex' ) or '0', 16 )
+
+
+def _fromInt( n_data, n_len ):
+  return '{0:0{1}x}'.format( n_data, n_len * 2 ).decode( 'hex' )
+
+
+def _masks( n_len ):
+  gMasks = _MASKS.get( n_len )
+  if gMasks is None:
+    nMask = (1 << (n_len * 8)) - 1
+    gMasks = (nMask, int( '80' * n_len or '0', 16 ))
+    if n_len <= _MASKS_LEN:
+      _MASKS[ n_len ] = gMasks
+  return gMasks
+
+
+##x Evaluates to bytewise sum of |n_a| and |n_b| modulo 256.
+def _add( n_a, n_b, n_len ):
+  nMask, nHigh = _masks( n_len )
+  nLow = nMask ^ nHigh
+  return ((n_a & nLow) + (n_b & nLow)) ^ ((n_a ^ n_b) & nHigh)
+
+
+##x Evaluates to bytewise difference of |s_a| and |s_b| modulo 256.
+def _subtract( s_a, s_b ):
+  nLen = len( s_a )
+  nMask, nHigh = _masks( nLen )
+  nA = _toInt( s_a )
+  nB = _toInt( s_b )
+  nResult = ((nA | nHigh) - (nB & ~nHigh & nMask)) ^ \
+    ((nA ^ ~nB) & nHigh & nMask)
+  return _fromInt( nResult & nMask, nLen )
+
+
+##  |(mask, high bits)| by length, in bytes. Only masks for lengths up to
+##  line of 256 pixels wide image with 16-bit 'RGBA' samples are cached,
+##  so whole images don't keep their masks.
+_MASKS = {}
+_MASKS_LEN = 256 * 8
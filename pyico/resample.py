@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico raw image resampling.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+import math
+
+import bmp
+
+
+##  Standard .ico image sizes.
+SIZES = [ 16, 24, 32, 48, 64, 128, 256 ]
+
+
+##x Resamples raw 32-bit data in 'RGBA' fromat using area averaging with
+##  premultiplied alpha, so colors of transparent pixels don't bleed into
+##  visible ones. Evaluates to resampled raw data.
+def resample( s_data, n_width, n_height, n_newWidth, n_newHeight ):
+  if bmp._numpy():
+    return _resampleNumpy( s_data, n_width, n_height, n_newWidth,
+      n_newHeight )
+  return _resamplePython( s_data, n_width, n_height, n_newWidth,
+    n_newHeight )
+
+
+##x Resamples raw 32-bit data in 'RGBA' fromat into square images of
+##  |l_sizes| sizes. Sizes are processed in parallel by |n_processes|
+##  processes, default is number of CPUs. Evaluates to list of resampled
+##  raw data, in same order as |l_sizes|.
+def resampleSizes( s_data, n_width, n_height, l_sizes = None,
+  n_processes = None ):
+  lSizes = l_sizes or SIZES
+  ##  Imported here since it's slow to import and rarely used.
+  import multiprocessing
+  lTasks = [ (s_data, n_width, n_height, n) for n in lSizes ]
+  nProcesses = n_processes or multiprocessing.cpu_count()
+  if nProcesses <= 1 or len( lTasks ) <= 1:
+    return map( _resampleTask, lTasks )
+  oPool = multiprocessing.Pool( min( nProcesses, len( lTasks ) ) )
+  try:
+    return oPool.map( _resampleTask, lTasks, chunksize = 1 )
+  finally:
+    oPool.terminate()
+    oPool.join()
+
+
+def _resampleTask( g_task ):
+  sData, nWidth, nHeight, nSize = g_task
+  return resample( sData, nWidth, nHeight, nSize, nSize )
+
+
+##x Evaluates to list of |(source index, weight)| lists, one for each of
+##  |n_to| pixels, that is area of source pixels covered by the pixel.
+def _weights( n_from, n_to ):
+  nScale = float( n_from ) / n_to
+  lWeights = []
+  for i in range( n_to ):
+    nBegin = i * nScale
+    nEnd = nBegin + nScale
+    lPixel = []
+    for j in range( int( nBegin ), min( n_from, int( math.ceil( nEnd ) ) ) ):
+      nOverlap = min( nEnd, j + 1 ) - max( nBegin, j )
+      if nOverlap > 0:
+        lPixel.append( (j, nOverlap / nScale) )
+    lWeights.append( lPixel )
+  return lWeights
+
+
+def _resamplePython( s_data, n_width, n_height, n_newWidth, n_newHeight ):
+  aData = bytearray( s_data[ : n_width * n_height * 4 ] )
+  ##  Premultiplied 'RGBA' float values.
+  lPixels = [ 0.0 ] * (n_width * n_height * 4)
+  for i in range( n_width * n_height ):
+    nAlpha = aData[ i * 4 + 3 ]
+    for j in range( 3 ):
+      lPixels[ i * 4 + j ] = aData[ i * 4 + j ] * nAlpha / 255.0
+    lPixels[ i * 4 + 3 ] = float( nAlpha )
+
+  ##  Horizontal pass.
+  lWeights = _weights( n_width, n_newWidth )
+  lLines = [ 0.0 ] * (n_newWidth * n_height * 4)
+  for y in range( n_height ):
+    for x, lPixel in enumerate( lWeights ):
+      nDst = (y * n_newWidth + x) * 4
+      for j, nWeight in lPixel:
+        nSrc = (y * n_width + j) * 4
+        for c in range( 4 ):
+          lLines[ nDst + c ] += lPixels[ nSrc + c ] * nWeight
+
+  ##  Vertical pass.
+  lWeights = _weights( n_height, n_newHeight )
+  lResult = [ 0.0 ] * (n_newWidth * n_newHeight * 4)
+  for y, lPixel in enumerate( lWeights ):
+    for j, nWeight in lPixel:
+      nSrc = j * n_newWidth * 4
+      nDst = y * n_newWidth * 4
+      for i in range( n_newWidth * 4 ):
+        lResult[ nDst + i ] += lLines[ nSrc + i ] * nWeight
+
+  aResult = bytearray( len( lResult ) )
+  for i in range( 0, len( lResult ), 4 ):
+    nAlpha = lResult[ i + 3 ]
+    if nAlpha > 0:
+      for c in range( 3 ):
+        aResult[ i + c ] = min( 255, int( lResult[ i + c ] * 255.0 / nAlpha +
+          0.5 ) )
+    aResult[ i + 3 ] = min( 255, int( nAlpha + 0.5 ) )
+  return str( aResult )
+
+
+def _resampleNumpy( s_data, n_width, n_height, n_newWidth, n_newHeight ):
+  numpy = bmp._numpy()
+  aData = numpy.frombuffer( s_data[ : n_width * n_height * 4 ], numpy.uint8 )
+  aData = aData.reshape( n_height, n_width, 4 ).astype( numpy.float64 )
+  aData[ :, :, : 3 ] *= aData[ :, :, 3 : ] / 255.0
+
+  ##  Resampling is a product of pixels and weight matrices.
+  def matrix( n_from, n_to ):
+    aMatrix = numpy.zeros( (n_to, n_from) )
+    for i, lPixel in enumerate( _weights( n_from, n_to ) ):
+      for j, nWeight in lPixel:
+        aMatrix[ i, j ] = nWeight
+    return aMatrix
+  aData = numpy.tensordot( matrix( n_height, n_newHeight ), aData, 1 )
+  aData = numpy.tensordot( matrix( n_width, n_newWidth ), aData,
+    axes = (1, 1) ).transpose( 1, 0, 2 )
+
+  aAlpha = aData[ :, :, 3 : ]
+  aSafe = numpy.where( aAlpha > 0, aAlpha, 1.0 )
+  aData[ :, :, : 3 ] = numpy.where( aAlpha > 0,
+    aData[ :, :, : 3 ] * 255.0 / aSafe, 0.0 )
+  aData = numpy.minimum( numpy.floor( aData + 0.5 ), 255 )
+  return aData.astype( numpy.uint8 ).tostring()
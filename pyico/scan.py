@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico metadata scanner.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+# Only icon header, image directory and PNG signature of each image are
+# read, so large collections of icons can be audited at disk speed.
+# Files are read by a pool of threads and invalid files are reported
+# instead of raising errors:
+#   from pyico import scan
+#   for oFile in scan.scan( lPaths ):
+#     print oFile.path_s, oFile.error_s or oFile.images_l
+
+import collections
+import multiprocessing.pool
+import os
+import struct
+
+import pyico
+import binary
+import png
+import stats
+
+
+##  Image directory entry, see |pyico.ICONDIRENTRY|, with 0 width and
+##  height replaced by 256. |png_f| is set if image data is PNG.
+IMAGE = collections.namedtuple( 'IMAGE',
+  pyico.ICONDIRENTRY._fields + ('png_f',) )
+##  Scanned file: it's size, in bytes, and list of |IMAGE|. If file can't
+##  be read or is not a valid .ico file, |error_s| is error description
+##  and |images_l| is |None|.
+FILE = collections.namedtuple( 'FILE', [
+  'path_s',
+  'size_n',
+  'images_l',
+  'error_s',
+])
+##  Default number of threads. Reads are short and mostly wait for disk,
+##  so it's not limited by number of CPUs.
+WORKERS = 16
+##  Default number of files that are read or wait to be yielded at once.
+LIMIT = 256
+
+
+##x Scans each file of |l_paths|, that can be any iterable including
+##  generator. Evaluates to generator of |FILE| in same order. Files are
+##  read by |n_workers| threads, no more than |n_limit| files are read
+##  ahead of caller, so memory is bounded for any number of files.
+def scan( l_paths, n_workers = WORKERS, n_limit = LIMIT ):
+  assert n_limit > 0
+  oPool = multiprocessing.pool.ThreadPool( n_workers )
+  lPending = collections.deque()
+  try:
+    for fp in l_paths:
+      if len( lPending ) >= n_limit:
+        yield lPending.popleft().get()
+      lPending.append( oPool.apply_async( scanFile, (fp,) ) )
+    while lPending:
+      yield lPending.popleft().get()
+  finally:
+    oPool.terminate()
+    oPool.join()
+
+
+##x Scans single file |fp|, evaluates to |FILE|.
+def scanFile( fp ):
+  nSize = None
+  try:
+    with open( fp, 'rb' ) as oFile:
+      nSize = os.fstat( oFile.fileno() ).st_size
+      lImages = _read( oFile, nSize )
+  except (AssertionError, IOError, OSError, struct.error) as oError:
+    return FILE( fp, nSize, None, str( oError ) or type( oError ).__name__ )
+  return FILE( fp, nSize, lImages, None )
+
+
+def _read( o_file, n_size ):
+  sHeader = o_file.read( 6 )
+  assert 6 == len( sHeader ), "icon header is truncated"
+  nReserved, nType, nImages = binary.compiled( '<HHH' ).unpack( sHeader )
+  assert 0 == nReserved and 1 == nType, "not an icon"
+  assert nImages > 0, "icon has no images"
+  nEntries = nImages * pyico.ICONDIRENTRY.STRUCT.size
+  oReader = binary.Reader( o_file.read( nEntries ) )
+  assert nEntries == len( oReader.data_s ), "image directory is truncated"
+  lEntries = [ oReader.readRecord( pyico.ICONDIRENTRY )
+    for i in range( nImages ) ]
+  nRead = 6 + nEntries
+  ##  Signatures are read in file order, so reads are sequential. Images
+  ##  can share data, see |pyico.WriterIco|.
+  mSignatures = {}
+  for oEntry in sorted( lEntries, key = lambda o: o.offset_n ):
+    assert oEntry.offset_n + oEntry.size_n <= n_size, \
+      "image data is out of file"
+    if oEntry.offset_n not in mSignatures:
+      o_file.seek( oEntry.offset_n )
+      mSignatures[ oEntry.offset_n ] = o_file.read( len( png.SIGNATURE ) )
+      nRead += len( png.SIGNATURE )
+  stats.count( 'bytes.read', nRead )
+  ##  Same as |pyico.ReaderIco|.
+  return [ IMAGE( * o._replace( width_n = o.width_n or 256,
+    height_n = o.height_n or 256 ) + (o.size_n > 8 and
+    png.SIGNATURE == mSignatures[ o.offset_n ],) ) for o in lEntries ]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding:utf-8 vi:et:ts=2
+
+# pyico instrumentation.
+# Copyright 2013 Grigory Petrov
+# See LICENSE for details.
+
+# Opt-in counters and timers of reading and writing phases. Disabled by
+# default, in which case each instrumented phase costs a single check:
+#   with pyico.stats.collect() as oStats:
+#     pyico.open( 'foo.ico' ).data()
+#   print oStats
+
+import contextlib
+import threading
+import time
+
+
+##  Statistics that are collected now, |None| if instrumentation is
+##  disabled.
+_stats_o = None
+
+
+class Stats( object ):
+
+
+  def __init__( self ):
+    ##  Counter values by name.
+    self.counters_m = {}
+    ##  Total time spent in phase, in seconds, by phase name.
+    self.timers_m = {}
+    ##  Values are updated by all threads of the process.
+    self._lock_o = threading.Lock()
+
+
+  ##x Called for each counter increment. Can be overridden to forward
+  ##  values into external metrics.
+  def add( self, s_name, n_value = 1 ):
+    with self._lock_o:
+      self.counters_m[ s_name ] = self.counters_m.get( s_name, 0 ) + n_value
+
+
+  ##x Called after each phase is finished. Can be overridden to forward
+  ##  values into external metrics.
+  def addTime( self, s_name, n_seconds ):
+    with self._lock_o:
+      self.timers_m[ s_name ] = self.timers_m.get( s_name, 0.0 ) + n_seconds
+    self.add( s_name, 1 )
+
+
+  def __str__( self ):
+    lLines = []
+    for sName in sorted( set( self.counters_m ) | set( self.timers_m ) ):
+      sLine = "{0:<16} {1:>10}".format( sName, self.counters_m.get( sName ) )
+      if sName in self.timers_m:
+        sLine += " {0:10.6f} s".format( self.timers_m[ sName ] )
+      lLines.append( sLine )
+    return '\n'.join( lLines )
+
+
+  def __repr__( self ):
+    return self.__str__()
+
+
+class _Phase( object ):
+
+
+  __slots__ = [ '_stats_o', '_name_s', '_start_n' ]
+
+
+  def __init__( self, o_stats, s_name ):
+    self._stats_o = o_stats
+    self._name_s = s_name
+    self._start_n = None
+
+
+  def __enter__( self ):
+    self._start_n = time.time()
+    return self
+
+
+  def __exit__( self, * args ):
+    self._stats_o.addTime( self._name_s, time.time() - self._start_n )
+    return False
+
+
+##  Phase that does nothing, used while instrumentation is disabled.
+class _NullPhase( object ):
+
+
+  __slots__ = []
+
+
+  def __enter__( self ):
+    return self
+
+
+  def __exit__( self, * args ):
+    return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def enabled():
+  return _stats_o is not None
+
+
+##x Adds |n_value| to counter |s_name|, if instrumentation is enabled.
+def count( s_name, n_value = 1 ):
+  if _stats_o is not None:
+    _stats_o.add( s_name, n_value )
+
+
+##x Evaluates to context manager that measures time of phase |s_name|,
+##  if instrumentation is enabled. Phase time is added to timer and
+##  counter of phase calls. Phases can be nested, time of nested phase is
+##  counted in outer phase as well.
+def phase( s_name ):
+  if _stats_o is None:
+    return _NULL_PHASE
+  return _Phase( _stats_o, s_name )
+
+
+##x Enables instrumentation inside a |with| block and evaluates to |Stats|
+##  object, |o_stats| if specified, that collects values. Statistics are
+##  collected for all threads of the process.
+@contextlib.contextmanager
+def collect( o_stats = None ):
+  global _stats_o
+  oStats = o_stats if o_stats is not None else Stats()
+  oPrev = _stats_o
+  _stats_o = oStats
+  try:
+    yield oStats
+  finally:
+    _stats_o = oPrev
@@ -42,7 +42,9 @@ setuptools.setup(
   packages     = [ NAME_SHORT ],
   zip_safe     = True,
   install_requires = [],
-  entry_points = {},
+  entry_points = {
+    'console_scripts': [ '{0} = {0}.cli:main'.format( NAME_SHORT ) ],
+  },
   ##  http://pypi.python.org/pypi?:action=list_classifiers
   classifiers  = [
     ('Development Status :: 1 - Planning'),
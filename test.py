@@ -21,3 +21,394 @@ oIco.addFromBmp( open( 'out.bmp', 'rb' ).read() )
 with open( 'out.ico', 'wb' ) as oFile:
   oFile.write( oIco.data() )
 
+
+##  Lazily opened icon must produce same data as fully decoded one.
+oIco = pyico.open( 'test.ico', f_lazy = True )
+assert oIco.data() == pyico.open( 'test.ico' ).data()
+
+##  Memory-mapped icon must be same as one that is read.
+oIco = pyico.open( 'test.ico' )
+for fLazy in [ False, True ]:
+  oIcoMmap = pyico.open( 'test.ico', f_lazy = fLazy, f_mmap = True )
+  assert oIco.data() == oIcoMmap.data()
+  for oImage, oImageMmap in zip( oIco.images_l, oIcoMmap.images_l ):
+    assert oImage.alpha() == oImageMmap.alpha()
+    assert oImage.raw() == oImageMmap.raw()
+oIco = pyico.open( 'test.ico', f_lazy = True )
+
+##  Icons can be copied and pickled, images are decoded again.
+import copy
+import pickle
+for fLazy, fMmap in [ (False, False), (True, False), (False, True) ]:
+  oIco = pyico.open( 'test.ico', f_lazy = fLazy, f_mmap = fMmap )
+  oIco.data()
+  for oIcoCopy in [ copy.deepcopy( oIco ) ] + [ pickle.loads( pickle.dumps(
+    oIco, n ) ) for n in [ 0, 2 ] ]:
+    assert oIco.data() == oIcoCopy.data()
+    assert [ o.raw() for o in oIco.images_l ] == \
+      [ o.raw() for o in oIcoCopy.images_l ]
+oIco = pyico.open( 'test.ico', f_lazy = True )
+
+##  Streamed icon must be same as one built in memory.
+with open( 'out.ico', 'wb' ) as oFile:
+  oIco.save( oFile )
+assert open( 'out.ico', 'rb' ).read() == oIco.data()
+
+##  All pixel codecs must decode same pixels as reference per-pixel
+##  decoder and encode them with padding bits cleared.
+import random
+from pyico import bmp
+sEngine = bmp.engine()
+random.seed( 0 )
+for nBpp in [ 1, 4, 8, 24, 32 ]:
+  for nWidth in [ 1, 7, 16, 33, 48 ]:
+    nLineSize = ((nWidth * nBpp + 31) / 32) * 4
+    sData = ''.join( chr( random.randrange( 256 ) )
+      for i in range( nLineSize * nWidth ) )
+    aPixels = bytearray()
+    aPacked = bytearray( len( sData ) )
+    for nY in range( nWidth ):
+      nLine = nY * nLineSize
+      for nX in range( nWidth ):
+        if nBpp <= 8:
+          nByte = nLine + nX * nBpp / 8
+          nShift = 8 - nBpp - nX * nBpp % 8
+          nPixel = (ord( sData[ nByte ] ) >> nShift) & ((1 << nBpp) - 1)
+          aPixels.append( nPixel )
+          aPacked[ nByte ] |= nPixel << nShift
+        else:
+          nByte = nLine + nX * nBpp / 8
+          sPixel = sData[ nByte : nByte + nBpp / 8 ]
+          aPixels += sPixel + '\x00' * (4 - len( sPixel ))
+          aPacked[ nByte : nByte + len( sPixel ) ] = sPixel
+    for sName in bmp.engines():
+      oEngine = bmp.ENGINES[ sName ]
+      if nBpp <= 8:
+        aResult = oEngine.unpackIndexes( sData, nBpp, nWidth, nWidth,
+          nLineSize )
+        sPacked = oEngine.packIndexes( aPixels, nBpp, nWidth, nWidth,
+          nLineSize )
+      else:
+        aResult = oEngine.unpackColors( sData, nBpp, nWidth, nWidth,
+          nLineSize )
+        sPacked = oEngine.packColors( aPixels, nBpp, nWidth, nWidth,
+          nLineSize )
+      assert str( aPixels ) == str( aResult ), (sName, nBpp, nWidth)
+      assert str( aPacked ) == str( sPacked ), (sName, nBpp, nWidth)
+lResults = []
+for sName in bmp.engines():
+  bmp.setEngine( sName )
+  oIco = pyico.open( 'test.ico' )
+  lResults.append( (oIco.data(), [ o.alpha() for o in oIco.images_l ]) )
+assert all( lResults[ 0 ] == o for o in lResults )
+bmp.setEngine( sEngine )
+
+##  Unchanged images are written back as is.
+oIco = pyico.open( 'test.ico' )
+assert oIco.data() == open( 'test.ico', 'rb' ).read()
+oIco.images_l[ 0 ].data_s = oIco.images_l[ 0 ].data_s
+assert pyico.load( oIco.data() ).images_l[ 0 ].data_s == \
+  oIco.images_l[ 0 ].data_s
+
+##  Raw data survives round trip.
+sRaw = ''.join( chr( random.randrange( 256 ) ) for i in range( 16 * 16 * 4 ) )
+oIco = pyico.Ico()
+oIco.addFromRaw( sRaw, 16, 16, 32 )
+assert pyico.load( oIco.data() ).images_l[ 0 ].raw() == sRaw
+
+##  All sizes are created from single master image.
+oIco = pyico.Ico()
+oIco.addSizesFromRaw( '\xFF\x00\x00\xFF' * 64 * 64, 64, 64, [ 16, 32 ] )
+assert [ 16, 32 ] == [ o.width_n for o in oIco.images_l ]
+assert (0xFF, 0, 0, 0xFF) == oIco.images_l[ 0 ].pixel( 7, 7 )
+
+##  Instrumentation is collected only inside |collect| block.
+with pyico.stats.collect() as oStats:
+  oIco = pyico.open( 'test.ico' )
+  oIco.images_l[ 0 ].data_s = oIco.images_l[ 0 ].data_s
+  oIco.data()
+assert len( oIco.images_l ) == oStats.counters_m[ 'decode' ]
+assert oStats.counters_m[ 'bytes.read' ] == \
+  len( open( 'test.ico', 'rb' ).read() )
+assert 'encode.pixels' in oStats.timers_m
+assert 'write.layout' in oStats.timers_m
+oIco.data()
+assert 1 == oStats.counters_m[ 'write.layout' ]
+import threading
+with pyico.stats.collect() as oStats:
+  lThreads = [ threading.Thread( target = lambda: [ pyico.stats.count( 'x' )
+    for i in range( 20000 ) ] ) for i in range( 4 ) ]
+  for oThread in lThreads:
+    oThread.start()
+  for oThread in lThreads:
+    oThread.join()
+assert 4 * 20000 == oStats.counters_m[ 'x' ]
+
+##  Background reading and writing.
+from pyico import aio
+oExecutor = aio.Executor( n_workers = 4, n_limit = 2 )
+lResults = [ pyico.aopen( 'test.ico', o_executor = oExecutor )
+  for i in range( 8 ) ]
+lIcons = [ o.get( 10 ) for o in lResults ]
+sData = open( 'test.ico', 'rb' ).read()
+assert all( sData == o.adata( oExecutor ).get( 10 ) for o in lIcons )
+lIcons[ 0 ].asave( 'out.ico', oExecutor ).get( 10 )
+assert sData == open( 'out.ico', 'rb' ).read()
+oExecutor.close()
+
+##  Cached icons are not affected by modification of returned copies.
+from pyico import cache
+oCache = cache.Cache()
+oIco = oCache.open( 'test.ico' )
+nImages = len( oIco.images_l )
+oIco.images_l[ 0 ].data_s = oIco.images_l[ 1 ].data_s
+oIco.images_l.pop()
+assert sData == oCache.open( 'test.ico' ).data()
+assert nImages == len( oCache.load( sData ).images_l )
+assert { 'hits': 1, 'misses': 2, 'entries': 2 } == dict( (s, n)
+  for s, n in oCache.stats().items() if s in [ 'hits', 'misses', 'entries' ] )
+oCache.budget_n = oCache.size() - 1
+oCache.open( 'out.ico' )
+assert 1 == oCache.stats()[ 'entries' ]
+
+##  Best matching image is selected by directory entries only.
+oIco = pyico.Ico()
+for nSize, nBpp in [ (16, 8), (16, 32), (32, 4), (48, 32) ]:
+  oImage = pyico.Image()
+  oImage.width_n = oImage.height_n = nSize
+  oImage.bpp_n = nBpp
+  oIco.images_l.append( oImage )
+assert (16, 32) == (oIco.best( 16 ).width_n, oIco.best( 16 ).bpp_n)
+assert (16, 8) == (oIco.best( 16, 8 ).width_n, oIco.best( 16, 8 ).bpp_n)
+assert (32, 4) == (oIco.best( 24, 32 ).width_n, oIco.best( 24, 32 ).bpp_n)
+assert 48 == oIco.best( 256 ).width_n
+oIco = pyico.open( 'test.ico', f_lazy = True )
+oImage = oIco.best( 32 )
+oImage.data_s
+assert [ o is oImage for o in oIco.images_l ] == \
+  [ o._data_s is not None for o in oIco.images_l ]
+
+##  Large images are written as PNG.
+import zlib
+from pyico import png
+oIco = pyico.open( 'test.ico' )
+for nThreads in [ 1, 4 ]:
+  oIcoPng = pyico.load( oIco.data( n_pngSize = 16, n_threads = nThreads ) )
+  for oImage, oImagePng in zip( oIco.images_l, oIcoPng.images_l ):
+    assert oImagePng.png_f == (oImage.png_f or oImage.width_n >= 16)
+    if oImagePng.png_f and not oImage.png_f:
+      oHeader = png.header( oImagePng.data_s )
+      assert (oImage.width_n, 32) == (oHeader.width_n, png.bpp( oHeader ))
+      ##  Lines are written with 'Up' filter.
+      nStride = oImage.width_n * 4
+      sLines = zlib.decompress( oImagePng.data_s[ 41 : -12 ] )
+      aPrev = bytearray( nStride )
+      for i in range( 0, len( sLines ), nStride + 1 ):
+        assert '\x02' == sLines[ i ]
+        aLine = bytearray( sLines[ i + 1 : i + 1 + nStride ] )
+        for j in range( nStride ):
+          aLine[ j ] = (aLine[ j ] + aPrev[ j ]) & 0xFF
+        assert oImage.raw()[ i / (nStride + 1) * nStride : ][ : nStride ] == \
+          str( aLine )
+        aPrev = aLine
+  assert oIcoPng.data() == oIco.data( n_pngSize = 16 )
+##  Images that are smaller are not decoded.
+oIcoLazy = pyico.open( 'test.ico', f_lazy = True )
+assert open( 'test.ico', 'rb' ).read() == oIcoLazy.data( n_pngSize = 32 )
+assert all( o._data_s is None for o in oIcoLazy.images_l )
+
+##  PNG images are decoded same as bitmaps they were written from.
+oIcoPng = pyico.load( oIco.data( n_pngSize = 16 ) )
+for oImage, oImagePng in zip( oIco.images_l, oIcoPng.images_l ):
+  assert oImagePng.png_f
+  assert oImage.raw() == oImagePng.raw()
+  assert oImage.alpha() == oImagePng.alpha()
+  assert 32 == oImagePng.bitmap().bpp()
+
+##  True color images are converted to palette, exactly if there are few
+##  colors.
+lColors = [ '\x10\x20\x30\xFF', '\x90\x80\x70\xFF', '\x00\x00\x00\x00' ]
+sRaw = ''.join( random.choice( lColors ) for i in range( 32 * 32 ) )
+oIco = pyico.Ico()
+oIco.addFromRaw( sRaw, 32, 32, 32 )
+for nBpp, fDither in [ (4, False), (8, True), (1, True) ]:
+  oIco.addFromBmp( oIco.images_l[ 0 ].data_s, nBpp, fDither )
+  oImage = pyico.load( oIco.data() ).images_l[ -1 ]
+  assert nBpp == oImage.bpp_n
+  assert oIco.images_l[ 0 ].alpha() == oImage.alpha()
+  lPixels = [ oImage.pixel( i % 32, i / 32 ) for i in range( 32 * 32 ) ]
+  if nBpp > 1:
+    assert all( tuple( bytearray( sRaw[ i * 4 : i * 4 + 4 ] ) ) == g
+      for i, g in enumerate( lPixels ) if g[ 3 ] )
+  else:
+    assert 2 == len( set( lPixels ) )
+
+##  Palette images are converted to smaller palette with transparent
+##  color, keeping their palette if it fits.
+lGrays = [ (i, i, i) for i in range( 16 ) ]
+for lPalette in [ lGrays[ : 9 ] + [ (0xFF, 0, 0xFF) ], lGrays[ : 10 ],
+  lGrays ]:
+  oBmp = bmp.Bmp()
+  oBmp._width_n = oBmp._height_n = oBmp._lineSize_n = 16
+  oBmp._bpp_n = 8
+  oBmp._colors_n = len( lPalette )
+  oBmp._palette_l = lPalette
+  oBmp._pixels_a = bytearray( i % len( lPalette ) for i in range( 256 ) )
+  oIco = pyico.Ico()
+  oIco.addFromBmp( oBmp.toBmp(), 4 )
+  oImage = pyico.load( oIco.data() ).images_l[ 0 ]
+  assert 4 == oImage.bpp_n
+  ##  Lines are bottom to top in bitmap.
+  lExpected = [ lPalette[ ((15 - i / 16) * 16 + i % 16) % len( lPalette ) ]
+    for i in range( 256 ) ]
+  lPixels = [ oImage.pixel( i % 16, i / 16 ) for i in range( 256 ) ]
+  assert [ (0xFF, 0, 0xFF) != g for g in lExpected ] == \
+    [ 0 != g[ 3 ] for g in lPixels ]
+  ##  16 colors don't fit with transparent one and are reduced.
+  nDiffer = sum( 1 for g1, g2 in zip( lExpected, lPixels )
+    if g2[ 3 ] and g1 != g2[ : 3 ] )
+  assert (nDiffer > 0) == (16 == len( lPalette ))
+
+##  Optimized images keep all visible pixels with fewer bytes.
+lRaws = [ sRaw,
+  ''.join( random.choice( lColors[ 1 : ] ) for i in range( 256 ) ),
+  ''.join( chr( i ) * 4 for i in range( 256 ) ), '\xFF\x00\xFF\xFF' * 256 ]
+oIco = pyico.Ico()
+for s in lRaws:
+  nSize = 32 if s is sRaw else 16
+  oIco.addFromRaw( s, nSize, nSize, 32 )
+oIcoOpt = pyico.load( oIco.data( f_optimize = True ) )
+assert 32 == bmp.losslessBpp( lRaws[ 2 ] )
+assert [ (4, False), (1, False), (32, True), (32, True) ] == \
+  [ g[ : 2 ] for g in oIco.optimized_l ]
+for oImage, oImageOpt, gReport in zip( oIco.images_l, oIcoOpt.images_l,
+  oIco.optimized_l ):
+  assert (gReport[ 0 ], gReport[ 1 ]) == (oImageOpt.bpp_n, oImageOpt.png_f)
+  assert gReport[ 3 ] == len( oImageOpt._encoded_o ) < gReport[ 2 ]
+  assert oImage.alpha() == oImageOpt.alpha()
+  assert all( g == oImageOpt.pixel( x, y ) for x, y, g in ((x, y,
+    oImage.pixel( x, y )) for x in range( oImage.width_n )
+    for y in range( oImage.height_n )) if g[ 3 ] )
+
+##  Identical payloads are written once and decoded once.
+import struct
+oIco = pyico.open( 'test.ico' )
+oIco.images_l.append( oIco.images_l[ 0 ].copy() )
+for i in range( 2 ):
+  oIco.images_l.append( pyico.Image() )
+  oIco.images_l[ -1 ].data_s = oIco.images_l[ 1 ].data_s
+sData = oIco.data()
+nImages = len( oIco.images_l )
+lEntries = [ struct.unpack_from( '<II', sData, 6 + i * 16 + 8 )
+  for i in range( nImages ) ]
+##  New images are same as decoded image they are assigned from.
+assert lEntries[ 0 ] == lEntries[ -3 ]
+assert lEntries[ 1 ] == lEntries[ -2 ] == lEntries[ -1 ]
+assert len( sData ) == 6 + nImages * 16 + sum( n for n, _ in
+  set( lEntries ) )
+with open( 'out.ico', 'wb' ) as oFile:
+  oIco.save( oFile )
+assert sData == open( 'out.ico', 'rb' ).read()
+for fLazy in [ False, True ]:
+  with pyico.stats.collect() as oStats:
+    oIcoShared = pyico.load( sData, f_lazy = fLazy )
+    assert [ o.data_s for o in oIco.images_l ] == \
+      [ o.data_s for o in oIcoShared.images_l ]
+  assert nImages - 3 == oStats.counters_m[ 'decode' ]
+  assert sData == oIcoShared.data()
+##  New image that is same as decoded one is shared by streamed icon too.
+lData = []
+for fStream in [ False, True ]:
+  oIcoShared = pyico.load( sData )
+  oIcoShared.images_l.append( pyico.Image() )
+  oIcoShared.images_l[ -1 ].data_s = oIcoShared.images_l[ 1 ].data_s
+  with open( 'out.ico', 'wb' ) as oFile:
+    oIcoShared.save( oFile ) if fStream else oFile.write( oIcoShared.data() )
+  lData.append( open( 'out.ico', 'rb' ).read() )
+assert lData[ 0 ] == lData[ 1 ]
+assert len( sData ) + 16 == len( lData[ 0 ] )
+
+##  Single image is replaced in place if it fits, else it's appended.
+import shutil
+oIco = pyico.open( 'test.ico' )
+shutil.copy( 'test.ico', 'out.ico' )
+nSize = os.path.getsize( 'out.ico' )
+for i, j in [ (1, 0), (0, 3), (3, 3) ]:
+  pyico.update( 'out.ico', i, oIco.images_l[ j ].copy() )
+  oIco.images_l[ i ] = oIco.images_l[ j ].copy()
+  assert [ o.data_s for o in oIco.images_l ] == \
+    [ o.data_s for o in pyico.open( 'out.ico' ).images_l ]
+assert nSize + 1128 == os.path.getsize( 'out.ico' )
+pyico.update( 'out.ico', 2, oIco.images_l[ 2 ].copy(), f_compact = True )
+assert oIco.data() == open( 'out.ico', 'rb' ).read()
+
+##  Metadata of many files is scanned without decoding, errors are
+##  reported for each file.
+from pyico import scan
+with open( 'out.ico', 'wb' ) as oFile:
+  oFile.write( open( 'test.ico', 'rb' ).read()[ : 100 ] )
+lPaths = [ 'test.ico', 'out.ico', 'missing.ico', __file__ ] * 3
+lFiles = list( scan.scan( iter( lPaths ), n_workers = 2, n_limit = 3 ) )
+assert lPaths == [ o.path_s for o in lFiles ]
+oIco = pyico.open( 'test.ico' )
+assert [ (o.width_n, o.bpp_n, o.png_f) for o in oIco.images_l ] == \
+  [ (o.width_n, o.bpp_n, o.png_f) for o in lFiles[ 0 ].images_l ]
+assert lFiles[ 0 ].error_s is None
+assert [ None ] * 3 == [ o.images_l for o in lFiles[ 1 : 4 ] ]
+assert [ 100, None ] == [ o.size_n for o in lFiles[ 1 : 3 ] ]
+assert all( o.error_s for o in lFiles[ 1 : 4 ] )
+assert scan.scanFile( 'out.ico' ).error_s.startswith( "image data" )
+oIco = pyico.Ico()
+oIco.addFromRaw( sRaw, 32, 32, 32 )
+with open( 'out.ico', 'wb' ) as oFile:
+  oFile.write( oIco.data( n_pngSize = 32 ) )
+assert scan.scanFile( 'out.ico' ).images_l[ 0 ].png_f
+
+##  Command-line converter mirrors subdirectories and keeps all images.
+import StringIO
+import sys
+from pyico import cli
+shutil.rmtree( 'cli', ignore_errors = True )
+for sDir in [ 'cli/in/a', 'cli/in/b' ]:
+  os.makedirs( sDir )
+  shutil.copy( 'out.bmp', sDir + '/foo.bmp' )
+oIco = pyico.open( 'test.ico' )
+oIco.images_l.append( oIco.images_l[ 0 ].copy() )
+with open( 'cli/in/a/foo.ico', 'wb' ) as oFile:
+  oIco.save( oFile )
+assert [ ('cli/in/a/foo.bmp', 'a'), ('cli/in/a/foo.ico', 'a'),
+  ('cli/in/b/foo.bmp', 'b') ] == cli.collect( [ 'cli/in' ] )
+oStderr, sys.stderr = sys.stderr, StringIO.StringIO()
+try:
+  assert 0 == cli.main( [ 'cli/in', '-o', 'cli/out', '-j', '2', '-c', '1' ] )
+  assert 1 == cli.main( [ 'cli/in/a/foo.bmp', 'cli/in/b/foo.bmp', '-o',
+    'cli/out', '-j', '1' ] )
+finally:
+  sys.stderr = oStderr
+assert [ 'foo.ico' ] == os.listdir( 'cli/out/b' )
+assert 1 + len( oIco.images_l ) == len( os.listdir( 'cli/out/a' ) )
+assert open( 'cli/out/a/foo_0_16x16x4.bmp', 'rb' ).read() == \
+  open( 'cli/out/a/foo_4_16x16x4.bmp', 'rb' ).read()
+shutil.rmtree( 'cli' )
+
+##  Import is fast and don't load heavy optional modules. Fastest of few
+##  imports is checked, since import time is affected by system load.
+import subprocess
+import sys
+lTimes = []
+for i in range( 3 ):
+  sModules = subprocess.check_output( [ sys.executable, '-c',
+    "import sys, time\n"
+    "nStart = time.time()\n"
+    "import pyico\n"
+    "print time.time() - nStart\n"
+    "import pyico.info\n"
+    "print ' '.join( sys.modules )\n" ] )
+  sTime, sModules = sModules.splitlines()
+  lTimes.append( float( sTime ) )
+assert min( lTimes ) < 0.05, lTimes
+for sModule in [ 'PIL', 'numpy', 'multiprocessing', 'pkg_resources' ]:
+  assert sModule not in sModules.split(), sModule
+##  Version is evaluated on first access.
+from pyico import info
+assert info.VER_TXT == info.version() and info.VER_TXT in info.DESCR